@@ -4,6 +4,8 @@ import time
 
 import pyparsing
 
+# shared with the MQL grammar, run with the repository root on the path
+from mql import identifiers
 from query_structures import (Dimension,
                               MetricSelector,
                               LogicalExpression,
@@ -28,18 +30,10 @@ decimal_number = (pyparsing.Optional(MINUS) + integer_number +
                   pyparsing.Optional("." + integer_number))
 decimal_number.setParseAction(lambda tokens: float("".join(tokens)))
 
-# Initialize non-ascii unicode code points in the Basic Multilingual Plane.
-unicode_printables = u''.join(
-    unichr(c) for c in range(128, 65536) if not unichr(c).isspace())
-
 # Does not like comma. No Literals from above allowed.
-valid_identifier_chars = (
-    (unicode_printables + pyparsing.alphanums + ".-_#$%&'*+/:;?@[\\]^`|"))
-
-metric_name = (
-    pyparsing.Word(pyparsing.alphas, valid_identifier_chars, min=1, max=255)("metric_name"))
-dimension_name = pyparsing.Word(valid_identifier_chars + ' ', min=1, max=255)
-dimension_value = pyparsing.Word(valid_identifier_chars + ' ', min=1, max=255)
+metric_name = identifiers.metric_name()("metric_name")
+dimension_name = identifiers.dimension_word()
+dimension_value = identifiers.dimension_word()
 
 dim_comparison_op = pyparsing.oneOf("=")
 
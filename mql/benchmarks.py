@@ -0,0 +1,369 @@
+import datetime
+import os
+import subprocess
+import sys
+import time
+
+import numpy
+import pyparsing
+from influxdb import resultset
+
+import data_types
+import influx_repo
+import mql_parser
+import program
+import query_structures
+import streaming
+import timeseries
+import utils
+
+# Benchmarks that do not need a database, run with 'run.py bench <name>'.
+
+_REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# third party imports are loaded first so only our own module time is measured
+_IMPORT_TIMER = (
+    "import time, numpy, pyparsing, influxdb\n"
+    "start_time = time.time()\n"
+    "{statement}\n"
+    "print(time.time() - start_time)\n")
+
+
+def _time_import(statement, cwd, env=None):
+    output = subprocess.check_output(
+        [sys.executable, '-c', _IMPORT_TIMER.format(statement=statement)], cwd=cwd, env=env)
+    return float(output.strip().splitlines()[-1])
+
+
+def legacy_identifier_table():
+    """Build the identifier Word elements the way both grammars used to."""
+    unicode_printables = u''.join(
+        unichr(c) for c in range(128, 65536) if not unichr(c).isspace())
+    valid_identifier_chars = (
+        (unicode_printables + pyparsing.alphanums + ".-_#$%&'*+/:;?@[\\]^`|"))
+    pyparsing.Word(pyparsing.alphas, valid_identifier_chars, min=1, max=255)
+    pyparsing.Word(valid_identifier_chars + ' ', min=1, max=255)
+    pyparsing.Word(valid_identifier_chars + ' ', min=1, max=255)
+
+
+def import_time(repeat=5):
+    """Time a cold import of each parser in a fresh interpreter."""
+    timings = {
+        'mql_parser': min(_time_import('from mql import mql_parser', _REPO_ROOT)
+                          for _ in range(repeat)),
+        # aql imports mql.identifiers from the repository root
+        'aql_parser': min(_time_import('import aql_parser', os.path.join(_REPO_ROOT, 'aql'),
+                                       dict(os.environ, PYTHONPATH=_REPO_ROOT))
+                          for _ in range(repeat)),
+    }
+    legacy = None
+    for _ in range(repeat):
+        start_time = time.time()
+        legacy_identifier_table()
+        elapsed = time.time() - start_time
+        legacy = elapsed if legacy is None else min(legacy, elapsed)
+
+    for name in sorted(timings):
+        print("Import {}: {:.1f}ms".format(name, timings[name] * 1000))
+    print("Legacy unicode identifier table, per parser: {:.1f}ms".format(legacy * 1000))
+    return 0
+
+
+def _synthetic_series(points, duration_sec, start_ms=1485187200000):
+    timestamps = start_ms + numpy.linspace(0, duration_sec * 1000, points, endpoint=False).astype(numpy.int64)
+    values = numpy.random.RandomState(0).random_sample(points) * 100
+    return timeseries.Series(timestamps.astype(timeseries.TIMESTAMP_DTYPE), values)
+
+
+def _legacy_records(data):
+    # the interleaved record layout series used to be stored in
+    return numpy.rec.fromarrays([data.timestamps, data.values])
+
+
+def legacy_split_into_bins(data, bins):
+    """Per point binning as MetricSelector.evaluate used to do it."""
+    bins = list(bins)
+    bins_inner_edges = bins[1:]
+    final_bins = list(bins)
+    bin_data = [[] for _ in range(len(bins_inner_edges) + 1)]
+    final_data = []
+    bin_indexes = numpy.digitize(data.f0, bins_inner_edges)
+    for i in range(len(bin_indexes)):
+        bin_data[bin_indexes[i]].append((data[i].f0, data[i].f1))
+    for i in range(len(bin_data)):
+        if len(bin_data[i]) > 0:
+            final_data.append(numpy.rec.array(bin_data[i]))
+    return final_bins, final_data
+
+
+def legacy_bin_average(final_data):
+    """Per bin average as BinnedRange.apply_function used to do it."""
+    return [numpy.mean(data.f1) for data in final_data]
+
+
+def binning(points=10 ** 6, legacy_points=10 ** 5):
+    """Time splitting a week of raw points into 5 minute bins and averaging them.
+
+    The per point legacy path is timed on fewer points to keep the run short,
+    and extrapolated to the same number of points.
+    """
+    duration_sec = 7 * 24 * 60 * 60
+    bucket_ms = 5 * 60 * 1000
+    data = _synthetic_series(points, duration_sec)
+    bins = numpy.arange(data.timestamps[0], data.timestamps[0] + duration_sec * 1000, bucket_ms)
+
+    start_time = time.time()
+    timestamps, values, offsets = utils.bin_series(data, bins)
+    binned = data_types.BinnedRange(None, bins, timestamps, values, offsets)
+    vectorized = time.time() - start_time
+    start_time = time.time()
+    binned.apply_function('avg')
+    vectorized_avg = time.time() - start_time
+
+    legacy_data = _legacy_records(_synthetic_series(legacy_points, duration_sec))
+    start_time = time.time()
+    legacy_bins, legacy_final_data = legacy_split_into_bins(legacy_data, bins)
+    legacy = (time.time() - start_time) * points / legacy_points
+    start_time = time.time()
+    legacy_bin_average(legacy_final_data)
+    legacy_avg = time.time() - start_time
+
+    print("Binning {} points into {} bins: {:.1f}ms vectorized, {:.1f}ms per point (extrapolated)".format(
+        points, len(bins), vectorized * 1000, legacy * 1000))
+    print("Averaging {} bins: {:.1f}ms with reduceat, {:.1f}ms per bin".format(
+        len(bins), vectorized_avg * 1000, legacy_avg * 1000))
+    return 0
+
+
+def series_storage(points=10 ** 6, repeat=20):
+    """Compare memory and arithmetic throughput of the ways to store a series' points.
+
+    Each layout is timed on scaling, offsetting and thresholding its values,
+    the compact one also on expanding back to a Series.
+    """
+    data = _synthetic_series(points, 7 * 24 * 60 * 60)
+    layouts = (('records', _legacy_records(data), lambda stored: stored.f1),
+               ('series', data, lambda stored: stored.values),
+               ('compact', timeseries.compact(data), lambda stored: stored.values))
+
+    for name, stored, values in layouts:
+        start_time = time.time()
+        for _ in range(repeat):
+            (values(stored) * 2 + 1) > 50
+        elapsed = (time.time() - start_time) / repeat
+        print("{} points as {}: {:.1f} bytes per point, {:.1f}M points/s".format(
+            points, name, float(stored.nbytes) / points, points / elapsed / 10 ** 6))
+
+    compact = layouts[2][1]
+    start_time = time.time()
+    expanded = compact.expand()
+    elapsed = time.time() - start_time
+    if not numpy.array_equal(expanded.timestamps, data.timestamps):
+        raise Exception('Compact timestamps differ')
+    print("Expanding compact series: {:.1f}ms, largest value error {:.2e}".format(
+        elapsed * 1000, numpy.max(numpy.abs(expanded.values - data.values))))
+    return 0
+
+
+def vector_math(series=5000, points=60):
+    """Time adding and comparing two vectors of many short series.
+
+    The right side is shuffled, as InfluxDB does not return series in any
+    particular order, so series have to be paired on their dimensions.
+    """
+    timestamps = numpy.arange(points, dtype=numpy.int64) * 60000
+    random_state = numpy.random.RandomState(0)
+    left = [data_types.Range(('net.in_bytes_sec', {'hostname': str(i)}),
+                             utils.get_result_array(timestamps, random_state.random_sample(points)))
+            for i in range(series)]
+    right = [data_types.Range(('net.out_bytes_sec', {'hostname': str(i)}),
+                              utils.get_result_array(timestamps, random_state.random_sample(points)))
+             for i in random_state.permutation(series)]
+
+    for name, make in (('list', data_types.VectorRange), ('aligned', data_types.make_vector_range)):
+        left_vector = make(left)
+        right_vector = make(right)
+        start_time = time.time()
+        (left_vector + right_vector) > 1
+        elapsed = time.time() - start_time
+        print("{} series x {} points, add and compare ({}): {:.1f}ms".format(
+            series, points, name, elapsed * 1000))
+    return 0
+
+
+def asof_join(points=10 ** 6, repeat=5):
+    """Time adding two unaligned series of different lengths, for each interpolation."""
+    duration_sec = 7 * 24 * 60 * 60
+    left = data_types.Range(('cpu.idle_perc', {}), _synthetic_series(points, duration_sec))
+    right_data = _synthetic_series(points * 2 / 3, duration_sec, start_ms=1485187200000 + 333)
+    right = data_types.Range(('cpu.idle_perc', {}), right_data)
+
+    interpolation = data_types.JOIN_INTERPOLATION
+    try:
+        for name in utils.INTERPOLATIONS:
+            data_types.JOIN_INTERPOLATION = name
+            start_time = time.time()
+            for _ in range(repeat):
+                result = left + right
+            elapsed = (time.time() - start_time) / repeat
+            print("{} + {} points ({}): {:.1f}ms, {} matched".format(
+                points, len(right_data), name, elapsed * 1000, len(result.data)))
+    finally:
+        data_types.JOIN_INTERPOLATION = interpolation
+    return 0
+
+
+def legacy_parse_influx_results(influx_data):
+    """Point by point decoding as influx_repo.parse_influx_results used to do it."""
+    results = []
+    for key, series in influx_data.items():
+        time_series = []
+        for point in series:
+            if point['value'] is None:
+                continue
+            time_series.append((point['time'], point['value']))
+        results.append((key, numpy.rec.array(time_series)))
+    return results
+
+
+def influx_parsing(series=20, points=50000, null_share=0.01):
+    """Time decoding a raw InfluxDB response, as returned with epoch='ms'."""
+    random_state = numpy.random.RandomState(0)
+    raw_series = []
+    for i in range(series):
+        values = (random_state.random_sample(points) * 100).tolist()
+        for j in numpy.flatnonzero(random_state.random_sample(points) < null_share):
+            values[j] = None
+        raw_series.append({'name': 'cpu.idle_perc',
+                           'tags': {'hostname': str(i)},
+                           'columns': ['time', 'value'],
+                           'values': [[1485187200000 + j * 1000, values[j]] for j in range(points)]})
+    influx_data = resultset.ResultSet({'series': raw_series})
+
+    start_time = time.time()
+    columnar = influx_repo.parse_influx_results(influx_data)
+    columnar_elapsed = time.time() - start_time
+    start_time = time.time()
+    legacy = legacy_parse_influx_results(influx_data)
+    legacy_elapsed = time.time() - start_time
+
+    for (key, data), (legacy_key, legacy_data) in zip(columnar, legacy):
+        if key != legacy_key or not numpy.array_equal(data.values, legacy_data.f1):
+            raise Exception('Decoded series differ for {}'.format(key))
+    print("Decoding {} series x {} points: {:.1f}ms columnar, {:.1f}ms per point".format(
+        series, points, columnar_elapsed * 1000, legacy_elapsed * 1000))
+    return 0
+
+
+def _raw_chunks(series, points, chunk_size, start_ms):
+    # a chunked response, generated as it is read so only one chunk exists at a time
+    random_state = numpy.random.RandomState(0)
+    for i in range(series):
+        for offset in range(0, points, chunk_size):
+            count = min(chunk_size, points - offset)
+            values = (random_state.random_sample(count) * 100).tolist()
+            yield resultset.ResultSet({'series': [{
+                'name': 'cpu.idle_perc',
+                'tags': {'hostname': str(i)},
+                'columns': ['time', 'value'],
+                'values': [[start_ms + (offset + j) * 1000, values[j]] for j in range(count)]}]})
+
+
+def stream_aggregation(series=20, points=50000, chunk_size=10000, bucket_sec=300):
+    """Time averaging raw points per bucket as they stream in, against decoding them all first.
+
+    Memory is reported as the bytes of decoded points held at once.
+    """
+    start_ms = 1485187200000
+    start_time = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=start_ms)
+    end_time = start_time + datetime.timedelta(seconds=points)
+
+    largest = [0]
+    generating = [0.0]
+
+    def measured(result_sets):
+        # generating the response is left out of the timing
+        while True:
+            begin = time.time()
+            result_set = next(result_sets, None)
+            generating[0] += time.time() - begin
+            if result_set is None:
+                return
+            largest[0] = max(largest[0], sum(len(raw['values']) for raw in result_set.raw['series']))
+            yield result_set
+
+    begin = time.time()
+    streamed = streaming.aggregate(measured(_raw_chunks(series, points, chunk_size, start_ms)), 'mean',
+                                   start_time, end_time, bucket_sec)
+    streamed_elapsed = time.time() - begin - generating[0]
+    streamed_bytes = largest[0] * timeseries.empty(1).nbytes
+
+    # the same points as one response
+    raw_series = []
+    for result_set in _raw_chunks(series, points, chunk_size, start_ms):
+        for raw in result_set.raw['series']:
+            if raw_series and raw_series[-1]['tags'] == raw['tags']:
+                raw_series[-1]['values'].extend(raw['values'])
+            else:
+                raw_series.append(raw)
+    begin = time.time()
+    decoded = influx_repo.parse_influx_results(resultset.ResultSet({'series': raw_series}))
+    bins = numpy.arange(start_ms, start_ms + points * 1000, bucket_sec * 1000)
+    whole = [data_types.BinnedRange(key, bins, *utils.bin_series(data, bins)).apply_function('avg')
+             for key, data in decoded]
+    whole_elapsed = time.time() - begin
+    whole_bytes = sum(data.nbytes for key, data in decoded)
+
+    for (key, data), average in zip(streamed, whole):
+        if not numpy.allclose(data.values, average.data.values):
+            raise Exception('Streamed averages differ for {}'.format(key))
+    print("Averaging {} series x {} points per {}s: {:.1f}ms streamed in chunks of {}, "
+          "{:.1f}ms decoded whole".format(series, points, bucket_sec, streamed_elapsed * 1000, chunk_size,
+                                          whole_elapsed * 1000))
+    print("Decoded points held at once: {:.1f}KB streamed, {:.1f}KB whole".format(
+        streamed_bytes / 1024.0, whole_bytes / 1024.0))
+    return 0
+
+
+def program_evaluation(series=3, points=5, repeat=20000):
+    """Time evaluating an alarm over fetched results, walking the tree and as a compiled program.
+
+    Series are small, as for alarms on one host, so the time is mostly
+    spent between the operations rather than in them.
+    """
+    expr = ('avg(cpu.idle_perc{hostname=dev} [5m]) < 10 and max(cpu.user_perc{hostname=dev} [5m]) * 2 > 50 '
+            'or sum(disk.space_used_perc{hostname=dev} [5m]) / 100 >= 0.9 and count(net.in_errors_sec [5m]) > 2')
+    tree = mql_parser.MQLParser(expr).parse()[0]
+    context = query_structures.EvaluationContext()
+    timestamps = numpy.arange(points, dtype=numpy.int64) * 60000
+    random_state = numpy.random.RandomState(0)
+    statements, saved = query_structures.plan(tree)
+    for selector, functions in statements:
+        for function in functions:
+            context.results[(selector.canonical_key, function)] = data_types.make_vector_range(
+                [data_types.Range((selector.name, {'hostname': str(i)}),
+                                  utils.get_result_array(timestamps, random_state.random_sample(points) * 100))
+                 for i in range(series)])
+
+    compiled = program.compile_tree(tree)
+    for name, evaluate in (('tree', tree.evaluate), ('program', compiled.evaluate)):
+        start_time = time.time()
+        for _ in range(repeat):
+            context.subtrees = {}
+            evaluate(context=context)
+        elapsed = (time.time() - start_time) / repeat
+        print("Alarm over {} series x {} points ({}): {:.1f}us".format(series, points, name, elapsed * 10 ** 6))
+    print("Compiled into {} steps".format(len(compiled)))
+    return 0
+
+
+benchmarks = {
+    'import': import_time,
+    'binning': binning,
+    'series': series_storage,
+    'vector': vector_math,
+    'asof': asof_join,
+    'influx': influx_parsing,
+    'stream': stream_aggregation,
+    'program': program_evaluation,
+}
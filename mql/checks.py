@@ -0,0 +1,396 @@
+import datetime
+import re
+import sys
+import threading
+
+import numpy
+from influxdb import resultset
+
+import data_types
+import influx_repo
+import mql_parser
+import utils
+
+# Evaluation checks against StubRepository, which answers the statements
+# build_query writes from points held in memory, run with 'run.py test'.
+
+_SUBQUERY = re.compile(r'^Select (.*?) from \((Select .*)\) where (.*?) group by (\S+)$')
+_QUERY = re.compile(r'^Select (.*?) from "([^"]+)"\s*(?: where (.*?))?\s*(?: group by (\S+))?\s*(?: limit (\d+))?$')
+_TIME_CLAUSE = re.compile(r"time (>=|<) '([^']+)'")
+_DIMENSION_CLAUSE = re.compile(r'"([^"]+)"(=~|!~|!=|=)(/(?:[^/\\]|\\.)*/|\'[^\']*\')')
+_FUNCTION = re.compile(r'(\w+)\(value\)')
+_BUCKET = re.compile(r'time\((\d+)s\)')
+
+_AGGREGATES = {
+    'mean': numpy.mean,
+    'sum': numpy.sum,
+    'count': len,
+    'min': numpy.min,
+    'max': numpy.max,
+    'last': lambda values: values[-1],
+}
+# aggregates stamped with the time of the point they pick
+_SELECTORS = {'min': numpy.argmin, 'max': numpy.argmax, 'last': lambda values: len(values) - 1}
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _to_ms(timestamp):
+    for time_format in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ'):
+        try:
+            return int((datetime.datetime.strptime(timestamp, time_format) - _EPOCH).total_seconds() * 1000)
+        except ValueError:
+            pass
+    raise Exception('Bad time \'{}\''.format(timestamp))
+
+
+def _dimension_matches(tags, key, operator, value):
+    tag = tags.get(key, '')
+    if '~' in operator:
+        matched = re.search(value[1:-1].replace('\\/', '/'), tag) is not None
+    else:
+        matched = tag == value[1:-1]
+    return matched == (operator in ('=', '=~'))
+
+
+def _select_parts(select):
+    parts = []
+    for part in select.split(', '):
+        expr, alias = part.rsplit(' as ', 1) if ' as ' in part else (part, 'value')
+        parts.append((expr, alias))
+    return parts
+
+
+class StubRepository(influx_repo.InfluxRepository):
+    """InfluxDB stand in, answers the statements build_query writes from points in memory.
+
+    `points` is {(name, {tag: value}): (timestamps in ms, values)}, sorted
+    by time. Every statement run is kept in `statements`, those on a
+    metric in `broken` raise.
+    """
+
+    def __init__(self, points, cache=None, broken=(), database='mon'):
+        influx_repo.InfluxRepository.__init__(self, database=database, cache=cache)
+        self.points = points
+        self.broken = broken
+        self.statements = []
+
+    def execute(self, statement):
+        return resultset.ResultSet({'series': self._series(statement)})
+
+    def execute_chunked(self, statement, chunk_size):
+        chunks = []
+        for series in self._series(statement):
+            for start in range(0, len(series['values']), chunk_size):
+                chunks.append(resultset.ResultSet(
+                    {'series': [dict(series, values=series['values'][start:start + chunk_size])]}))
+        return iter(chunks)
+
+    def _series(self, statement):
+        self.statements.append(statement)
+        for name in self.broken:
+            if '"{}"'.format(name) in statement:
+                raise Exception('Failed to query {}'.format(name))
+        return self._run(statement.strip())
+
+    def _run(self, statement):
+        match = _SUBQUERY.match(statement)
+        if match is not None:
+            select, inner, where, group_by = match.groups()
+            limit = None
+            series = []
+            for raw in self._run(inner):
+                rows = raw['values']
+                series.append((raw['name'], raw['tags'],
+                               numpy.array([row[0] for row in rows], dtype=numpy.int64),
+                               numpy.array([row[1] for row in rows], dtype=numpy.float64)))
+        else:
+            match = _QUERY.match(statement)
+            if match is None:
+                raise Exception('Stub cannot run \'{}\''.format(statement))
+            select, name, where, group_by, limit = match.groups()
+            series = [(series_name, dict(tags), timestamps, values)
+                      for (series_name, tags), (timestamps, values) in sorted(self.points.items())
+                      if name == '/.*/' or series_name == name]
+
+        where = where or ''
+        start_ms, end_ms = None, None
+        for operator, timestamp in _TIME_CLAUSE.findall(where):
+            if operator == '>=':
+                start_ms = _to_ms(timestamp)
+            else:
+                end_ms = _to_ms(timestamp)
+        dimensions = _DIMENSION_CLAUSE.findall(where)
+        bucket = _BUCKET.search(group_by or '')
+        bucket_ms = int(bucket.group(1)) * 1000 if bucket is not None else None
+
+        results = []
+        for series_name, tags, timestamps, values in series:
+            if not all(_dimension_matches(tags, *dimension) for dimension in dimensions):
+                continue
+            inside = numpy.ones(len(timestamps), dtype=numpy.bool_)
+            if start_ms is not None:
+                inside &= timestamps >= start_ms
+            if end_ms is not None:
+                inside &= timestamps < end_ms
+            rows = self._select(_select_parts(select), timestamps[inside], values[inside], start_ms, bucket_ms)
+            if limit is not None:
+                rows = rows[:int(limit)]
+            if rows:
+                results.append({'name': series_name, 'tags': tags,
+                                'columns': ['time'] + [alias for expr, alias in _select_parts(select)],
+                                'values': rows})
+        return results
+
+    def _select(self, parts, timestamps, values, start_ms, bucket_ms):
+        functions = [_FUNCTION.search(expr) for expr, alias in parts]
+        if functions[0] is not None and functions[0].group(1) == 'derivative':
+            # per second rate of every point from the one before, stamped with the later one
+            elapsed = numpy.diff(timestamps) / 1000.0
+            return [[int(timestamp), float(rate)]
+                    for timestamp, rate in zip(timestamps[1:], numpy.diff(values) / elapsed)]
+        if functions[0] is None:
+            columns = [eval(expr, {'value': values}) for expr, alias in parts]
+            return [[int(timestamp)] + [float(column[i]) for column in columns]
+                    for i, timestamp in enumerate(timestamps)]
+
+        if bucket_ms is not None:
+            keys = timestamps - timestamps % bucket_ms
+        else:
+            keys = numpy.full(len(timestamps), start_ms, dtype=numpy.int64)
+        rows = []
+        for key in numpy.unique(keys):
+            bucket_values = values[keys == key]
+            row_time = int(key)
+            if bucket_ms is None and len(parts) == 1 and functions[0].group(1) in _SELECTORS:
+                row_time = int(timestamps[keys == key][_SELECTORS[functions[0].group(1)](bucket_values)])
+            row = [row_time]
+            for (expr, alias), function in zip(parts, functions):
+                aggregate = float(_AGGREGATES[function.group(1)](bucket_values))
+                row.append(eval(expr.replace(function.group(0), repr(aggregate))))
+            rows.append(row)
+        return rows
+
+
+def make_points(now, hosts=('a', 'b'), name='cpu', step_sec=10, days=1):
+    """A point every step_sec for a day before now and an hour after, for each host."""
+    start_ms = (int((now - _EPOCH).total_seconds()) - days * 86400) // step_sec * step_sec * 1000
+    timestamps = numpy.arange(start_ms, start_ms + (days * 86400 + 3600) * 1000, step_sec * 1000,
+                              dtype=numpy.int64)
+    points = {}
+    for offset, host in enumerate(hosts):
+        values = 50 + 40 * numpy.sin(timestamps / 3.6e6 + offset) + (timestamps / 10000 % 7)
+        points[(name, (('hostname', host),))] = (timestamps, values)
+    return points
+
+
+def with_repository(repository, check):
+    """Run check with repository answering every query."""
+    previous = influx_repo._repository
+    influx_repo._repository = repository
+    try:
+        return check()
+    finally:
+        influx_repo._repository = previous
+
+
+def _compare(expr, left, right):
+    differences = mql_parser.compare_results(left, right)
+    assert not differences, '{}: {}'.format(expr, differences)
+
+
+def check_parse_cache_backends(now):
+    """Each parser backend has its own entries in a shared parse cache."""
+    cache = mql_parser.ParseCache()
+    for backend in ('pyparsing', 'pratt', 'pyparsing', 'pratt'):
+        mql_parser.MQLParser('avg(cpu [5m])', cache=cache, backend=backend).parse()
+    assert (cache.hits, cache.misses) == (2, 2), cache.stats()
+
+
+def check_inner_arithmetic(now):
+    """Arithmetic inside a function applies to every point, with and without rewriting."""
+    repository = StubRepository(make_points(now))
+
+    def check():
+        for expr in ['count(cpu{hostname=a} [1h] + 5)', 'sum(cpu [1h] + 1)', 'max(cpu [1h] * -1)',
+                     'max(100 - cpu [1h])', 'rate(cpu [5m over 1h] + 5)', 'avg(cpu [1h] * 100)',
+                     'avg(cpu [1h]) * 100', 'max(cpu [1h]) * -1', '100 - max(cpu [1h])']:
+            tree = mql_parser.MQLParser(expr).parse()[0]
+            pushed = mql_parser.PreparedQuery(expr, tree).evaluate(now)
+            client_side = mql_parser.PreparedQuery(expr, tree, rewrite=False).evaluate(now)
+            _compare(expr, pushed, client_side)
+
+        count = mql_parser.MQLParser('count(cpu{hostname=a} [1h] + 5)').prepare().evaluate(now)
+        assert count.data[0].data.values[0] == 360, count
+        inner = mql_parser.MQLParser('avg(cpu [1h] * 100)').prepare().tree
+        outer = mql_parser.MQLParser('avg(cpu [1h]) * 100').prepare().tree
+        assert not isinstance(inner.operand, mql_parser.MetricSelector), repr(inner)
+        assert isinstance(outer.operand, mql_parser.MetricSelector), repr(outer)
+    with_repository(repository, check)
+    # count, sum and rate are only taken of points with the arithmetic applied
+    for statement in repository.statements:
+        assert not re.search(r'(count|sum|derivative)\(', statement), statement
+
+
+def check_rate_pushdown(now):
+    """Rates are the same pushed down or not, with windows aligned to the buckets or not."""
+    repository = StubRepository(make_points(now))
+
+    def check():
+        for expr in ['rate(cpu [5m over 1h])', 'avg(rate(cpu{hostname=b} [1m over 30m]))']:
+            for align in (None, 'bucket'):
+                pushed = mql_parser.MQLParser(expr).prepare(align=align).evaluate(now)
+                client_side = mql_parser.MQLParser(expr).prepare(align=align, push_down_rate=False).evaluate(now)
+                _compare('{} align={}'.format(expr, align), pushed, client_side)
+    with_repository(repository, check)
+
+
+def check_connection_pool(now):
+    """The adapter in use blocks once pool_size connections are taken."""
+    repository = influx_repo.InfluxRepository(host='localhost', pool_size=3, cache=None)
+    for url in ('http://localhost:8086', 'https://localhost:8086'):
+        adapter = repository._client._session.get_adapter(url)
+        assert adapter._pool_block, url
+        assert adapter._pool_maxsize == 3, adapter._pool_maxsize
+
+
+def check_cache_keeps_windows(now):
+    """Results are the same with the default cache as without one."""
+    points = make_points(now)
+    for expr in ['cpu [5m]', 'avg(cpu [1h])', 'sum(cpu [5m over 1h])', 'cpu [10m] + cpu [5m] offset 10m']:
+        results = []
+        for cache in (None, influx_repo.ResultCache()):
+            repository = StubRepository(points, cache=cache)
+            results.append(with_repository(
+                repository, lambda: mql_parser.MQLParser(expr).prepare().evaluate(now)))
+        _compare(expr, *results)
+
+
+def check_cache_per_database(now):
+    """Repositories sharing a cache only get the results of their own database."""
+    cache = influx_repo.ResultCache()
+    results = []
+    for database, hosts in (('mon', ('a',)), ('other', ('b',))):
+        repository = StubRepository(make_points(now, hosts=hosts), cache=cache, database=database)
+        results.append(with_repository(
+            repository, lambda: mql_parser.MQLParser('cpu [5m]').prepare().evaluate(now)))
+    tags = [[serie.definition[1] for serie in result.data] for result in results]
+    assert tags == [[{'hostname': 'a'}], [{'hostname': 'b'}]], tags
+
+
+def check_incremental_buckets(now):
+    """Incremental evaluation over moving nows matches a fresh evaluation."""
+    repository = StubRepository(make_points(now))
+
+    def check():
+        for expr in ['sum(cpu [5m over 2h])', 'avg(cpu [5m over 2h])', 'count(cpu [5m over 2h])',
+                     'cpu [5m over 1h]', 'cpu [10m]']:
+            incremental = mql_parser.MQLParser(expr).prepare(incremental=True)
+            for step in range(8):
+                step_now = now + datetime.timedelta(seconds=37 * step)
+                fresh = mql_parser.MQLParser(expr).prepare().evaluate(step_now)
+                _compare('{} at {}'.format(expr, step_now), incremental.evaluate(step_now), fresh)
+            window = incremental.windows.values()[0]
+            assert window.delta_fetches == 7, (expr, window.full_fetches, window.delta_fetches)
+    with_repository(repository, check)
+
+
+def check_worker_threads(now):
+    """Recurring evaluations reuse the same prefetch threads."""
+    repository = StubRepository(make_points(now))
+    query = mql_parser.MQLParser('avg(cpu [5m]) + max(cpu [10m]) + min(cpu [15m])').prepare()
+
+    def check():
+        query.evaluate(now)
+        threads = threading.active_count()
+        for step in range(20):
+            query.evaluate(now + datetime.timedelta(seconds=step))
+        assert threading.active_count() == threads, (threads, threading.active_count())
+    with_repository(repository, check)
+
+
+def _boolean_series(result):
+    return sorted((str(serie.definition), serie.data.timestamps.tolist(), serie.data.values.tolist())
+                  for serie in result.data)
+
+
+def check_shifted_boolean_vectors(now):
+    """Boolean vectors on different grids join as-of, aligned or not."""
+    for left_start, right_start in ((0, 90000), (0, 30000), (0, 0)):
+        vectors = []
+        for start in (left_start, right_start):
+            timestamps = numpy.arange(start, start + 180000, 60000, dtype=numpy.int64)
+            vectors.append([data_types.Range(('cpu', {'hostname': host}),
+                                             utils.get_result_array(timestamps, numpy.array([1.0, -1.0, 2.0])))
+                            for host in ('a', 'b')])
+        left, right = vectors
+        aligned_left, aligned_right = data_types.make_vector_range(left), data_types.make_vector_range(right)
+        assert isinstance(aligned_left > 0, data_types.AlignedBooleanVectorRange)
+        for operation in (lambda x, y: x & y, lambda x, y: x | y):
+            aligned = operation(aligned_left > 0, aligned_right > 0)
+            listed = operation(data_types.VectorRange(left) > 0, data_types.VectorRange(right) > 0)
+            assert _boolean_series(aligned) == _boolean_series(listed), (_boolean_series(aligned),
+                                                                         _boolean_series(listed))
+
+
+def check_streamed_aggregates(now):
+    """Aggregates streamed in chunks match those InfluxDB computes, timestamps included."""
+    repository = StubRepository(make_points(now))
+
+    def check():
+        for expr in ['max(cpu [1h])', 'min(cpu{hostname=a} [1h])', 'avg(cpu [1h])', 'count(cpu [1h])',
+                     'max(cpu [5m over 1h])', 'sum(cpu [5m over 1h])', 'avg(cpu [1h]) + max(cpu [1h])']:
+            del repository.statements[:]
+            streamed = mql_parser.MQLParser(expr).prepare(stream_chunk_size=50).evaluate(now)
+            assert all(statement.startswith('Select value ') for statement in repository.statements), \
+                repository.statements
+            _compare(expr, streamed, mql_parser.MQLParser(expr).prepare().evaluate(now))
+    with_repository(repository, check)
+
+
+def check_batch_failures(now):
+    """A failing statement or expression in a batch only fails the expressions using it."""
+    repository = StubRepository(make_points(now), broken=('broken',))
+    exprs = ['avg(cpu{hostname=a} [5m])', 'avg(broken{hostname=a} [5m])', 'max(cpu [1h]) + avg(broken [1h])',
+             'avg(cpu [1h]', 'cpu{hostname=b} [5m]']
+
+    def check():
+        for max_workers in (1, 4):
+            results = mql_parser.prepare_batch(exprs).evaluate(now, max_workers=max_workers)
+            unrewritten = mql_parser.prepare_batch(exprs, push_down_rate=False, rewrite=False).evaluate(now)
+            for result, other in zip(results, unrewritten):
+                if not isinstance(result, Exception):
+                    _compare('batch without rewrites', result, other)
+            for index in (1, 2, 3):
+                assert isinstance(results[index], Exception), (exprs[index], results[index])
+            for index in (0, 4):
+                alone = mql_parser.MQLParser(exprs[index]).prepare().evaluate(now)
+                _compare(exprs[index], results[index], alone)
+    with_repository(repository, check)
+
+
+def check_last_point_fetched_once(now):
+    """Functions of a selector without a range all read its last point, with one statement."""
+    repository = StubRepository(make_points(now))
+
+    def check():
+        expr = 'min(cpu) + avg(cpu) + max(cpu)'
+        result = mql_parser.MQLParser(expr).prepare().evaluate(now)
+        assert len(repository.statements) == 1, repository.statements
+        _compare(expr, result, mql_parser.MQLParser('cpu * 3').prepare().evaluate(now))
+    with_repository(repository, check)
+
+
+def main():
+    now = datetime.datetime(2017, 1, 23, 16, 3, 17)
+    for check in (check_parse_cache_backends, check_inner_arithmetic, check_rate_pushdown,
+                  check_connection_pool, check_cache_keeps_windows, check_cache_per_database,
+                  check_incremental_buckets, check_worker_threads, check_shifted_boolean_vectors,
+                  check_streamed_aggregates, check_batch_failures, check_last_point_fetched_once):
+        check(now)
+        print('{} passed'.format(check.__name__))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
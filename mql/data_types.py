@@ -1,26 +1,52 @@
 import numpy
 
+import timeseries
 import utils
 
+# how far apart, and how, points of two series are matched up, see
+# utils.asof_indexes for the interpolations. Booleans are not interpolated,
+# they take 'previous' or 'nearest'.
+JOIN_TOLERANCE_MS = 60000
+JOIN_INTERPOLATION = 'nearest'
+BOOLEAN_JOIN_INTERPOLATION = 'nearest'
+
+
+def _match_series(left, right, on=None, ignoring=None):
+    """Pair the elements of two list form vectors, by dimensions when they have them."""
+    left_definitions = [getattr(data, 'definition', None) for data in left]
+    right_definitions = [getattr(data, 'definition', None) for data in right]
+    if None in left_definitions or None in right_definitions:
+        # plain values carry no dimensions, pair them by position
+        if len(left) != len(right):
+            raise Exception('Cannot combine uneven Vectors')
+        return range(len(left)), range(len(right))
+    return utils.match_definitions(left_definitions, right_definitions, on, ignoring)
+
 
 class VectorRange(object):
+    """A list of series.
+
+    Binary operations between two vectors pair series with equal dimensions
+    (or equal `on` dimensions, or equal dimensions `ignoring` some), series
+    without a partner are dropped from the result.
+    """
+
     def __init__(self, data):
         self.data = data
 
-    def _basic_math(self, operation, other):
+    def _basic_math(self, operation, other, on=None, ignoring=None):
         if isinstance(other, VectorRange):
-            if len(self.data) != len(other.data):
-                raise Exception('Cannot add uneven Vectors')
+            left_indexes, right_indexes = _match_series(self.data, other.data, on, ignoring)
             new_data = []
-            for i in range(len(self.data)):
+            for i, j in zip(left_indexes, right_indexes):
                 if operation == 'add':
-                    new_data.append(self.data[i] + other.data[i])
+                    new_data.append(self.data[i] + other.data[j])
                 elif operation == 'sub':
-                    new_data.append(self.data[i] - other.data[i])
+                    new_data.append(self.data[i] - other.data[j])
                 elif operation == 'mul':
-                    new_data.append(self.data[i] * other.data[i])
+                    new_data.append(self.data[i] * other.data[j])
                 elif operation == 'div':
-                    new_data.append(self.data[i] / other.data[i])
+                    new_data.append(self.data[i] / other.data[j])
             return VectorRange(new_data)
         elif isinstance(other, (int, float)):
             new_data = []
@@ -37,6 +63,16 @@ class VectorRange(object):
         else:
             raise Exception('Not Implemented')
 
+    def binary_operation(self, operation, other, on=None, ignoring=None):
+        """Apply 'add', 'sub', 'mul', 'div', 'gte', 'gt', 'lte' or 'lt' to other.
+
+        Series are paired on the `on` dimensions only, or on all dimensions
+        except `ignoring`, instead of all of them.
+        """
+        if operation in {'gte', 'gt', 'lte', 'lt'}:
+            return self._basic_comparison(operation, other, on, ignoring)
+        return self._basic_math(operation, other, on, ignoring)
+
     def __add__(self, other):
         return self._basic_math('add', other)
 
@@ -46,6 +82,10 @@ class VectorRange(object):
     def __sub__(self, other):
         return self._basic_math('sub', other)
 
+    def __rsub__(self, other):
+        # number - self, negating is exact so this equals the subtraction
+        return self._basic_math('mul', -1)._basic_math('add', other)
+
     def __mul__(self, other):
         return self._basic_math('mul', other)
 
@@ -55,20 +95,19 @@ class VectorRange(object):
     def __div__(self, other):
         return self._basic_math('div', other)
 
-    def _basic_comparison(self, operation, other):
+    def _basic_comparison(self, operation, other, on=None, ignoring=None):
         if isinstance(other, VectorRange):
-            if len(self.data) != len(other.data):
-                raise Exception('Cannot compare uneven Vectors')
+            left_indexes, right_indexes = _match_series(self.data, other.data, on, ignoring)
             new_data = []
-            for i in range(len(self.data)):
+            for i, j in zip(left_indexes, right_indexes):
                 if operation == 'gte':
-                    new_data.append(self.data[i] >= other.data[i])
+                    new_data.append(self.data[i] >= other.data[j])
                 elif operation == 'gt':
-                    new_data.append(self.data[i] > other.data[i])
+                    new_data.append(self.data[i] > other.data[j])
                 elif operation == 'lte':
-                    new_data.append(self.data[i] <= other.data[i])
+                    new_data.append(self.data[i] <= other.data[j])
                 elif operation == 'lt':
-                    new_data.append(self.data[i] < other.data[i])
+                    new_data.append(self.data[i] < other.data[j])
             return BooleanVectorRange(new_data)
         elif isinstance(other, (int, float)):
             new_data = []
@@ -116,22 +155,20 @@ class BooleanVectorRange(object):
 
     def __and__(self, other):
         if isinstance(other, BooleanVectorRange):
-            if len(self.data) != len(other.data):
-                raise Exception('Cannot combine uneven Vectors')
+            left_indexes, right_indexes = _match_series(self.data, other.data)
             new_data = []
-            for i in range(len(self.data)):
-                new_data.append(self.data[i] & other.data[i])
+            for i, j in zip(left_indexes, right_indexes):
+                new_data.append(self.data[i] & other.data[j])
             return BooleanVectorRange(new_data)
         else:
             raise Exception('Not Implemented')
 
     def __or__(self, other):
         if isinstance(other, BooleanVectorRange):
-            if len(self.data) != len(other.data):
-                raise Exception('Cannot combine uneven Vectors')
+            left_indexes, right_indexes = _match_series(self.data, other.data)
             new_data = []
-            for i in range(len(self.data)):
-                new_data.append(self.data[i] | other.data[i])
+            for i, j in zip(left_indexes, right_indexes):
+                new_data.append(self.data[i] | other.data[j])
             return BooleanVectorRange(new_data)
         else:
             raise Exception('Not Implemented')
@@ -149,52 +186,296 @@ class BooleanVectorRange(object):
         return '\n'.join([str(data) for data in self.data])
 
 
+# minimum share of the series x timestamps matrix that must hold points for
+# a vector to be stored aligned, below it the data is treated as ragged
+MIN_ALIGNED_DENSITY = 0.5
+
+
+def make_vector_range(data):
+    """Wrap a list of Ranges, in aligned form when they share a time grid.
+
+    Falls back to the list form for binned or ragged data.
+    """
+    if not data or not all(type(serie) is Range for serie in data):
+        return VectorRange(data)
+    lengths = numpy.array([len(serie.data) for serie in data])
+    all_timestamps = numpy.concatenate([serie.data.timestamps for serie in data])
+    timestamps = numpy.unique(all_timestamps)
+    if len(all_timestamps) < MIN_ALIGNED_DENSITY * len(data) * len(timestamps):
+        return VectorRange(data)
+
+    rows = numpy.repeat(numpy.arange(len(data)), lengths)
+    columns = numpy.searchsorted(timestamps, all_timestamps)
+    cells = rows * len(timestamps) + columns
+    if len(numpy.unique(cells)) != len(cells):
+        # repeated timestamps within a series do not fit in a grid
+        return VectorRange(data)
+
+    values = numpy.full((len(data), len(timestamps)), numpy.nan)
+    mask = numpy.zeros((len(data), len(timestamps)), dtype=numpy.bool_)
+    values.flat[cells] = numpy.concatenate([serie.data.values for serie in data])
+    mask.flat[cells] = True
+    return AlignedVectorRange([serie.definition for serie in data], timestamps, values, mask)
+
+
+class AlignedVectorRange(VectorRange):
+    """A vector of Ranges sharing one time grid, stored as a matrix.
+
+    `values` has one row per series and one column per timestamp, cells
+    without a point hold NaN and are False in `mask`. Arithmetic and
+    comparisons with scalars or other aligned vectors are single array
+    operations: series are paired with a hash join on their dimensions and,
+    on different grids, the right side is read at the left one's timestamps
+    as Range does. Anything else goes through the list form in `data`.
+    """
+
+    def __init__(self, definitions, timestamps, values, mask):
+        self.definitions = definitions
+        self.timestamps = timestamps
+        self.values = values
+        self.mask = mask
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = [Range(self.definitions[i],
+                                utils.get_result_array(self.timestamps[self.mask[i]],
+                                                       self.values[i][self.mask[i]]))
+                          for i in range(len(self.definitions))]
+        return self._data
+
+    def _take(self, indexes):
+        indexes = numpy.asarray(indexes, dtype=numpy.intp)
+        return AlignedVectorRange([self.definitions[i] for i in indexes], self.timestamps,
+                                  self.values[indexes], self.mask[indexes])
+
+    def _join(self, other, on=None, ignoring=None):
+        """Matching rows of both vectors, with other's values read on this grid.
+
+        Returns (left, right, right_values, right_mask), or None when the
+        grids differ and other has missing points, as the nearest point of
+        each series may then sit in a different column.
+        """
+        left_indexes, right_indexes = utils.match_definitions(self.definitions, other.definitions, on, ignoring)
+        left = self._take(left_indexes)
+        right = other._take(right_indexes)
+        if numpy.array_equal(left.timestamps, right.timestamps):
+            return left, right, right.values, right.mask
+        if not numpy.all(right.mask):
+            return None
+        matched, lower, upper, weight = utils.asof_indexes(left.timestamps, right.timestamps,
+                                                           JOIN_TOLERANCE_MS, JOIN_INTERPOLATION)
+        right_mask = numpy.repeat(matched[numpy.newaxis, :], len(right.definitions), axis=0)
+        return left, right, utils.asof_values(right.values, lower, upper, weight), right_mask
+
+    def _basic_math(self, operation, other, on=None, ignoring=None):
+        joined = None
+        if isinstance(other, AlignedVectorRange):
+            joined = self._join(other, on, ignoring)
+        if joined is not None:
+            left, right, other_values, other_mask = joined
+            new_mask = left.mask & other_mask
+            new_definitions = [utils.reduce_definitions(left_definition, right_definition)
+                               for left_definition, right_definition in zip(left.definitions, right.definitions)]
+        elif isinstance(other, (int, float)):
+            left = self
+            other_values = other
+            new_mask = self.mask
+            new_definitions = self.definitions
+        else:
+            return VectorRange._basic_math(self, operation, other, on, ignoring)
+
+        if operation == 'add':
+            new_values = left.values + other_values
+        elif operation == 'sub':
+            new_values = left.values - other_values
+        elif operation == 'mul':
+            new_values = left.values * other_values
+        elif operation == 'div':
+            new_values = left.values / other_values
+        new_values[~new_mask] = numpy.nan
+        return AlignedVectorRange(new_definitions, left.timestamps, new_values, new_mask)
+
+    def _basic_comparison(self, operation, other, on=None, ignoring=None):
+        joined = None
+        if isinstance(other, AlignedVectorRange):
+            joined = self._join(other, on, ignoring)
+        if joined is not None:
+            left, right, other_values, other_mask = joined
+            new_mask = left.mask & other_mask
+        elif isinstance(other, (int, float)):
+            left = self
+            other_values = other
+            new_mask = self.mask
+        else:
+            return VectorRange._basic_comparison(self, operation, other, on, ignoring)
+
+        # NaN cells compare False, the mask keeps them apart from real results
+        with numpy.errstate(invalid='ignore'):
+            if operation == 'gte':
+                new_values = left.values >= other_values
+            elif operation == 'gt':
+                new_values = left.values > other_values
+            elif operation == 'lte':
+                new_values = left.values <= other_values
+            elif operation == 'lt':
+                new_values = left.values < other_values
+        return AlignedBooleanVectorRange(left.definitions, left.timestamps, new_values & new_mask, new_mask)
+
+    def apply_function(self, function, extra_args=None):
+        if function not in {'avg', 'max', 'min', 'count', 'sum'} or not numpy.all(numpy.any(self.mask, axis=1)):
+            return VectorRange.apply_function(self, function, extra_args)
+
+        # as Range.apply_function, the result sits at the first timestamp of each series
+        with numpy.errstate(invalid='ignore'):
+            if function == 'avg':
+                results = numpy.nanmean(self.values, axis=1)
+            elif function == 'max':
+                results = numpy.nanmax(self.values, axis=1)
+            elif function == 'min':
+                results = numpy.nanmin(self.values, axis=1)
+            elif function == 'count':
+                results = numpy.sum(self.mask, axis=1)
+            elif function == 'sum':
+                results = numpy.nansum(self.values, axis=1)
+        first_timestamps = self.timestamps[numpy.argmax(self.mask, axis=1)]
+        return VectorRange([Range(self.definitions[i],
+                                  utils.get_result_array(first_timestamps[i:i + 1], results[i:i + 1]))
+                            for i in range(len(self.definitions))])
+
+
+class AlignedBooleanVectorRange(BooleanVectorRange):
+    """Boolean counterpart of AlignedVectorRange, masked cells hold False."""
+
+    def __init__(self, definitions, timestamps, values, mask):
+        self.definitions = definitions
+        self.timestamps = timestamps
+        self.values = values
+        self.mask = mask
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = [BooleanRange(self.definitions[i],
+                                       utils.get_boolean_result_array(self.timestamps[self.mask[i]],
+                                                                      self.values[i][self.mask[i]]))
+                          for i in range(len(self.definitions))]
+        return self._data
+
+    def _join(self, other):
+        """Matching rows of both vectors, with other's values read on this grid.
+
+        Returns (left, right_values, right_mask), or None when other is not
+        aligned, or the grids differ and other has missing points, as with
+        AlignedVectorRange._join.
+        """
+        if not isinstance(other, AlignedBooleanVectorRange):
+            return None
+        left_indexes, right_indexes = utils.match_definitions(self.definitions, other.definitions)
+        left_indexes = numpy.asarray(left_indexes, dtype=numpy.intp)
+        right_indexes = numpy.asarray(right_indexes, dtype=numpy.intp)
+        left = AlignedBooleanVectorRange([self.definitions[i] for i in left_indexes], self.timestamps,
+                                         self.values[left_indexes], self.mask[left_indexes])
+        right_values = other.values[right_indexes]
+        right_mask = other.mask[right_indexes]
+        if numpy.array_equal(self.timestamps, other.timestamps):
+            return left, right_values, right_mask
+        if not numpy.all(right_mask):
+            return None
+        matched, nearest, _, _ = utils.asof_indexes(self.timestamps, other.timestamps,
+                                                    JOIN_TOLERANCE_MS, BOOLEAN_JOIN_INTERPOLATION)
+        right_mask = numpy.repeat(matched[numpy.newaxis, :], len(right_indexes), axis=0)
+        return left, right_values[:, nearest] & right_mask, right_mask
+
+    def __and__(self, other):
+        joined = self._join(other)
+        if joined is None:
+            return BooleanVectorRange.__and__(self, other)
+        left, other_values, other_mask = joined
+        new_mask = left.mask & other_mask
+        return AlignedBooleanVectorRange(left.definitions, left.timestamps,
+                                         left.values & other_values & new_mask, new_mask)
+
+    def __or__(self, other):
+        joined = self._join(other)
+        if joined is None:
+            return BooleanVectorRange.__or__(self, other)
+        left, other_values, other_mask = joined
+        new_mask = left.mask & other_mask
+        return AlignedBooleanVectorRange(left.definitions, left.timestamps,
+                                         (left.values | other_values) & new_mask, new_mask)
+
+    def apply_function(self, function, extra_args=None):
+        if function not in BooleanRange.supported_functions:
+            raise Exception('Unexpected input type boolean range for function {}'.format(function))
+        if function == 'any':
+            results = numpy.any(self.values, axis=1)
+        elif function == 'all':
+            results = numpy.all(self.values | ~self.mask, axis=1)
+        return BooleanVectorRange(list(results))
+
+
 class BinnedRange(object):
-    def __init__(self, definition, bins, data):
+    """A series split into consecutive time bins.
+
+    Points live in two contiguous, time sorted arrays. `offsets` holds the
+    index of the first point of every bin, so bin i spans
+    offsets[i]:offsets[i + 1]. Empty bins are kept, with zero length.
+    """
+
+    def __init__(self, definition, bins, timestamps, values, offsets):
         self.definition = definition
         self.bins = bins
-        self.data = data
+        self.timestamps = timestamps
+        self.values = values
+        self.offsets = offsets
+
+    @property
+    def counts(self):
+        return utils.bin_counts(self.offsets, len(self.values))
+
+    @property
+    def data(self):
+        # per bin views, for display
+        ends = numpy.append(self.offsets[1:], len(self.values))
+        return [utils.get_result_array(self.timestamps[start:end], self.values[start:end])
+                for start, end in zip(self.offsets, ends)]
+
+    def _validate_matching(self, other):
+        if len(self.bins) != len(other.bins):
+            raise Exception('Cannot combine uneven BinnedRanges')
+        utils.validate_timestamp_matching(self.bins, other.bins)
+        if not numpy.array_equal(self.offsets, other.offsets) or len(self.values) != len(other.values):
+            raise Exception('Cannot combine mismatched bins')
 
     def _basic_math(self, operation, other):
         if isinstance(other, BinnedRange):
-            if len(self.data) != len(other.data):
-                raise Exception('Cannot add uneven BinnedRanges')
-            utils.validate_timestamp_matching(self.bins, other.bins)
-            new_data = []
-            for i in range(len(self.data)):
-                result_data = utils.create_rec_array(len(self.data[i].f0))
-                try:
-                    result_data.f0 = (self.data[i].f0 + other.data[i].f0) / 2
-                    if operation == 'add':
-                        result_data.f1 = self.data[i].f1 + other.data[i].f1
-                    elif operation == 'sub':
-                        result_data.f1 = self.data[i].f1 - other.data[i].f1
-                    elif operation == 'mul':
-                        result_data.f1 = self.data[i].f1 * other.data[i].f1
-                    elif operation == 'div':
-                        result_data.f1 = self.data[i].f1 / other.data[i].f1
-                    new_data.append(result_data)
-                except ValueError:
-                    raise Exception('Cannot add mismatched bins')
+            self._validate_matching(other)
+            new_timestamps = (self.timestamps + other.timestamps) / 2
+            if operation == 'add':
+                new_values = self.values + other.values
+            elif operation == 'sub':
+                new_values = self.values - other.values
+            elif operation == 'mul':
+                new_values = self.values * other.values
+            elif operation == 'div':
+                new_values = self.values / other.values
             new_definition = utils.reduce_definitions(self.definition, other.definition)
             new_bins = (self.bins + other.bins) / 2
 
-            return BinnedRange(new_definition, new_bins, new_data)
+            return BinnedRange(new_definition, new_bins, new_timestamps, new_values, self.offsets)
         elif isinstance(other, (int, float)):
-            new_data = []
-            for data in self.data:
-                result_data = utils.create_rec_array(len(self.data.f0))
-                result_data.f0 = data.f0
-                if operation == 'add':
-                    result_data.f1 = data.f1 + other
-                elif operation == 'sub':
-                    result_data.f1 = data.f1 - other
-                elif operation == 'mul':
-                    result_data.f1 = data.f1 * other
-                elif operation == 'div':
-                    result_data.f1 = data.f1 / other
-                new_data.append(result_data)
-            return BinnedRange(self.definition, self.bins, new_data)
+            if operation == 'add':
+                new_values = self.values + other
+            elif operation == 'sub':
+                new_values = self.values - other
+            elif operation == 'mul':
+                new_values = self.values * other
+            elif operation == 'div':
+                new_values = self.values / other
+            return BinnedRange(self.definition, self.bins, self.timestamps, new_values, self.offsets)
         else:
             raise Exception('Not Implemented')
 
@@ -207,6 +488,10 @@ class BinnedRange(object):
     def __sub__(self, other):
         return self._basic_math('sub', other)
 
+    def __rsub__(self, other):
+        # number - self, negating is exact so this equals the subtraction
+        return self._basic_math('mul', -1)._basic_math('add', other)
+
     def __mul__(self, other):
         return self._basic_math('mul', other)
 
@@ -218,44 +503,21 @@ class BinnedRange(object):
 
     def _basic_comparison(self, operation, other):
         if isinstance(other, BinnedRange):
-            if len(self.data) != len(other.data):
-                raise Exception('Cannot compare uneven BinnedRanges')
-            utils.validate_timestamp_matching(self.bins, other.bins)
-            new_data = []
-            for i in range(len(self.data)):
-                result_data = utils.create_bool_rec_array(len(self.data[i].f0))
-                try:
-                    result_data.f0 = self.data[i].f0
-                    if operation == 'gte':
-                        result_data.f1 = self.data[i].f1 >= other.data[i].f1
-                    elif operation == 'gt':
-                        result_data.f1 = self.data[i].f1 > other.data[i].f1
-                    elif operation == 'lte':
-                        result_data.f1 = self.data[i].f1 <= other.data[i].f1
-                    elif operation == 'lt':
-                        result_data.f1 = self.data[i].f1 < other.data[i].f1
-                    new_data.append(result_data)
-                except ValueError:
-                    raise Exception('Cannot compare mismatched bins')
-            return BooleanBinnedRange(self.definition, self.bins, new_data)
-        elif isinstance(other, (int, float)):
-            new_data = []
-            for data in self.data:
-                result_data = utils.create_bool_rec_array(len(data.f0))
-                result_data.f0 = data.f0
-                if operation == 'gte':
-                    result_data.f1 = data.f1 >= other
-                elif operation == 'gt':
-                    result_data.f1 = data.f1 > other
-                elif operation == 'lte':
-                    result_data.f1 = data.f1 <= other
-                elif operation == 'lt':
-                    result_data.f1 = data.f1 < other
-                new_data.append(result_data)
-            return BooleanBinnedRange(self.definition, self.bins, new_data)
-        else:
+            self._validate_matching(other)
+            other = other.values
+        elif not isinstance(other, (int, float)):
             raise Exception('Not Implemented')
 
+        if operation == 'gte':
+            new_values = self.values >= other
+        elif operation == 'gt':
+            new_values = self.values > other
+        elif operation == 'lte':
+            new_values = self.values <= other
+        elif operation == 'lt':
+            new_values = self.values < other
+        return BooleanBinnedRange(self.definition, self.bins, self.timestamps, new_values, self.offsets)
+
     def __ge__(self, other):
         return self._basic_comparison('gte', other)
 
@@ -272,57 +534,41 @@ class BinnedRange(object):
         if function not in {'avg', 'max', 'min', 'count', 'sum', 'rate'}:
             raise Exception('Unsupported input type grouped Range for function {}'.format(function))
 
-        if function == 'avg':
-            print(type(self.bins))
-            data_result = []
-            for data in self.data:
-                data_result.append(numpy.mean(data.f1))
-            result = utils.get_result_array(self.bins, data_result)
-            return Range(self.definition, result)
-
-        if function == 'max':
-            data_result = []
-            for data in self.data:
-                data_result.append(numpy.amax(data.f1))
-            result = utils.get_result_array(self.bins, data_result)
-            return Range(self.definition, result)
-
-        if function == 'min':
-            data_result = []
-            for data in self.data:
-                data_result.append(numpy.amin(data.f1))
-            result = utils.get_result_array(self.bins, data_result)
-            return Range(self.definition, result)
-
-        if function == 'count':
-            data_result = []
-            for data in self.data:
-                data_result.append(len(data.f1))
-            result = utils.get_result_array(self.bins, data_result)
-            return Range(self.definition, result)
-
-        if function == 'sum':
-            data_result = []
-            for data in self.data:
-                data_result.append(numpy.sum(data.f1))
-            result = utils.get_result_array(self.bins, data_result)
-            return Range(self.definition, result)
-
         if function == 'rate':
-            result = []
-            for i in range(len(self.data)):
-                data = self.data[i]
-                new_times = data.f0[1:]
-                new_data = numpy.diff(data.f1) / numpy.diff(data.f0 / 1000)
-                # discard empty bins
-                if len(new_data) > 0:
-                    result.append(utils.get_result_array(new_times, new_data))
-                else:
-                    del self.bins[i]
-            return BinnedRange(self.definition, self.bins, result)
+            # differences are only taken between points of the same bin,
+            # so every non-empty bin loses its first point
+            counts = self.counts
+            non_empty = counts > 0
+            is_bin_start = numpy.zeros(len(self.values), dtype=numpy.bool_)
+            is_bin_start[self.offsets[non_empty]] = True
+            keep = ~is_bin_start[1:]
+            rates = numpy.diff(self.values) / (numpy.diff(self.timestamps.astype(numpy.float64)) / 1000)
+            removed_before = numpy.cumsum(non_empty) - non_empty
+            return BinnedRange(self.definition, self.bins,
+                               self.timestamps[1:][keep], rates[keep],
+                               self.offsets - removed_before)
+
+        # empty bins have no aggregate, leave them out as a server side group by would
+        counts = self.counts
+        non_empty = counts > 0
+        starts = self.offsets[non_empty]
+        if function == 'count':
+            data_result = counts[non_empty]
+        elif len(starts) == 0:
+            data_result = numpy.empty(0)
+        elif function == 'avg':
+            data_result = numpy.add.reduceat(self.values, starts) / counts[non_empty]
+        elif function == 'max':
+            data_result = numpy.maximum.reduceat(self.values, starts)
+        elif function == 'min':
+            data_result = numpy.minimum.reduceat(self.values, starts)
+        elif function == 'sum':
+            data_result = numpy.add.reduceat(self.values, starts)
+        result = utils.get_result_array(self.bins[non_empty], data_result)
+        return Range(self.definition, result)
 
     def __repr__(self):
-        output = [self.data[i].tolist() for i in range(len(self.data)) if not isinstance(self.data[i], list)]
+        output = [data.tolist() for data in self.data]
         return str(self.definition) + '\n' + '\n'.join(str(bin) for bin in output)
 
     def __str__(self):
@@ -332,44 +578,43 @@ class BinnedRange(object):
 class BooleanBinnedRange(object):
     supported_functions = {'any', 'all'}
 
-    def __init__(self, definition, bins, data):
+    def __init__(self, definition, bins, timestamps, values, offsets):
         self.definition = definition
         self.bins = bins
-        self.data = data
+        self.timestamps = timestamps
+        self.values = values
+        self.offsets = offsets
+
+    @property
+    def counts(self):
+        return utils.bin_counts(self.offsets, len(self.values))
+
+    @property
+    def data(self):
+        ends = numpy.append(self.offsets[1:], len(self.values))
+        return [utils.get_boolean_result_array(self.timestamps[start:end], self.values[start:end])
+                for start, end in zip(self.offsets, ends)]
+
+    def _validate_matching(self, other):
+        if len(self.bins) != len(other.bins):
+            raise Exception('Cannot compare uneven BinnedRanges')
+        utils.validate_timestamp_matching(self.bins, other.bins)
+        if not numpy.array_equal(self.offsets, other.offsets) or len(self.values) != len(other.values):
+            raise Exception('Cannot compare mismatched bins')
 
     def __and__(self, other):
         if isinstance(other, BooleanBinnedRange):
-            if len(self.data) != len(other.data):
-                raise Exception('Cannot compare uneven BinnedRanges')
-            utils.validate_timestamp_matching(self.bins, other.bins)
-            new_data = []
-            for i in range(len(self.data)):
-                result_data = utils.create_bool_rec_array(len(self.data[i].f0))
-                try:
-                    result_data.f0 = self.data[i].f0
-                    result_data.f1 = numpy.logical_and(self.data[i].f1,  other.data[i].f1)
-                    new_data.append(result_data)
-                except ValueError:
-                    raise Exception('Cannot compare mismatched bins')
-            return BooleanBinnedRange(self.definition, self.bins, new_data)
+            self._validate_matching(other)
+            new_values = numpy.logical_and(self.values, other.values)
+            return BooleanBinnedRange(self.definition, self.bins, self.timestamps, new_values, self.offsets)
         else:
             raise Exception('Not Implemented')
 
     def __or__(self, other):
         if isinstance(other, BooleanBinnedRange):
-            if len(self.data) != len(other.data):
-                raise Exception('Cannot compare uneven BinnedRanges')
-            utils.validate_timestamp_matching(self.bins, other.bins)
-            new_data = []
-            for i in range(len(self.data)):
-                result_data = utils.create_bool_rec_array(len(self.data[i].f0))
-                try:
-                    result_data.f0 = self.data[i].f0
-                    result_data.f1 = numpy.logical_or(self.data[i].f1,  other.data[i].f1)
-                    new_data.append(result_data)
-                except ValueError:
-                    raise Exception('Cannot compare mismatched bins')
-            return BooleanBinnedRange(self.definition, self.bins, new_data)
+            self._validate_matching(other)
+            new_values = numpy.logical_or(self.values, other.values)
+            return BooleanBinnedRange(self.definition, self.bins, self.timestamps, new_values, self.offsets)
         else:
             raise Exception('Not Implemented')
 
@@ -377,60 +622,75 @@ class BooleanBinnedRange(object):
         if function not in self.supported_functions:
             raise Exception('Unexpected input type grouped boolean range for function {}'.format(function))
 
-        if function == 'any':
-            new_data = []
-            for data in self.data:
-                new_data.append(numpy.any(data.f1))
-            result = utils.get_boolean_result_array(self.bins, new_data)
-            return BooleanRange(self.definition, result)
-        if function == 'all':
-            new_data = []
-            for data in self.data:
-                new_data.append(numpy.all(data.f1))
-            result = utils.get_boolean_result_array(self.bins, new_data)
-            return BooleanRange(self.definition, result)
+        non_empty = self.counts > 0
+        starts = self.offsets[non_empty]
+        if len(starts) == 0:
+            new_data = numpy.empty(0, dtype=numpy.bool_)
+        elif function == 'any':
+            new_data = numpy.logical_or.reduceat(self.values, starts)
+        elif function == 'all':
+            new_data = numpy.logical_and.reduceat(self.values, starts)
+        result = utils.get_boolean_result_array(self.bins[non_empty], new_data)
+        return BooleanRange(self.definition, result)
 
     def __repr__(self):
-        output = [self.data[i].tolist() for i in range(len(self.data)) if not isinstance(self.data[i], list)]
+        output = [data.tolist() for data in self.data]
         return str(self.definition) + '\n' + '\n'.join(str(bin) for bin in output)
 
 
+def _asof_join(left, right, interpolation):
+    """Points of left with a point of right in reach, and right's values at them.
+
+    See utils.asof_indexes, with JOIN_TOLERANCE_MS.
+    """
+    if numpy.array_equal(left.timestamps, right.timestamps):
+        return left, right.values
+    if numpy.any(right.timestamps[1:] < right.timestamps[:-1]):
+        right = right[numpy.argsort(right.timestamps, kind='mergesort')]
+    matched, lower, upper, weight = utils.asof_indexes(left.timestamps, right.timestamps,
+                                                       JOIN_TOLERANCE_MS, interpolation)
+    return left[matched], utils.asof_values(right.values, lower[matched], upper[matched], weight[matched])
+
+
 class Range(object):
+    """A single series.
+
+    Two Ranges combine point by point on the timestamps of the left one:
+    each is matched with the right one's value there, read as set by
+    JOIN_INTERPOLATION from points at most JOIN_TOLERANCE_MS away. Points
+    with nothing in reach are dropped.
+    """
+
     def __init__(self, definition, data):
         self.definition = definition
         self.data = data
 
     def _basic_math(self, operation, other):
         if isinstance(other, Range):
-            utils.validate_timestamp_matching(self.data.f0, other.data.f0)
-            new_data = utils.create_rec_array(len(self.data.f0))
-            try:
-                new_data.f0 = (self.data.f0 + other.data.f0) / 2
-                if operation == 'add':
-                    new_data.f1 = self.data.f1 + other.data.f1
-                elif operation == 'sub':
-                    new_data.f1 = self.data.f1 - other.data.f1
-                elif operation == 'mul':
-                    new_data.f1 = self.data.f1 * other.data.f1
-                elif operation == 'div':
-                    new_data.f1 = self.data.f1 / other.data.f1
-            except ValueError:
-                raise Exception('Cannot add uneven ranges')
+            left, other_values = _asof_join(self.data, other.data, JOIN_INTERPOLATION)
+            timestamps = left.timestamps
+            if operation == 'add':
+                values = left.values + other_values
+            elif operation == 'sub':
+                values = left.values - other_values
+            elif operation == 'mul':
+                values = left.values * other_values
+            elif operation == 'div':
+                values = left.values / other_values
             new_definition = utils.reduce_definitions(self.definition, other.definition)
-            return Range(new_definition, new_data)
+            return Range(new_definition, timeseries.Series(timestamps, values))
 
         elif isinstance(other, (int, float)):
-            new_data = utils.create_rec_array(len(self.data.f0))
-            new_data.f0 = self.data.f0
+            timestamps = self.data.timestamps
             if operation == 'add':
-                new_data.f1 = self.data.f1 + other
+                values = self.data.values + other
             elif operation == 'sub':
-                new_data.f1 = self.data.f1 - other
+                values = self.data.values - other
             elif operation == 'mul':
-                new_data.f1 = self.data.f1 * other
+                values = self.data.values * other
             elif operation == 'div':
-                new_data.f1 = self.data.f1 / other
-            return Range(self.definition, new_data)
+                values = self.data.values / other
+            return Range(self.definition, timeseries.Series(timestamps, values))
 
         else:
             raise Exception('Not Implemented')
@@ -444,6 +704,10 @@ class Range(object):
     def __sub__(self, other):
         return self._basic_math('sub', other)
 
+    def __rsub__(self, other):
+        # number - self, negating is exact so this equals the subtraction
+        return self._basic_math('mul', -1)._basic_math('add', other)
+
     def __mul__(self, other):
         return self._basic_math('mul', other)
 
@@ -455,33 +719,28 @@ class Range(object):
 
     def _basic_comparison(self, operation, other):
         if isinstance(other, Range):
-            utils.validate_timestamp_matching(self.data.f0, other.data.f0)
-            new_data = utils.create_bool_rec_array(len(self.data.f0))
-            try:
-                new_data.f0 = self.data.f0
-                if operation == 'gte':
-                    new_data.f1 = self.data.f1 >= other.data.f1
-                elif operation == 'gt':
-                    new_data.f1 = self.data.f1 > other.data.f1
-                elif operation == 'lte':
-                    new_data.f1 = self.data.f1 <= other.data.f1
-                elif operation == 'lt':
-                    new_data.f1 = self.data.f1 < other.data.f1
-            except ValueError:
-                raise Exception('Cannot compare uneven ranges')
-            return BooleanRange(self.definition, new_data)
+            left, other_values = _asof_join(self.data, other.data, JOIN_INTERPOLATION)
+            timestamps = left.timestamps
+            if operation == 'gte':
+                values = left.values >= other_values
+            elif operation == 'gt':
+                values = left.values > other_values
+            elif operation == 'lte':
+                values = left.values <= other_values
+            elif operation == 'lt':
+                values = left.values < other_values
+            return BooleanRange(self.definition, timeseries.Series(timestamps, values))
         elif isinstance(other, (int, float)):
-            new_data = utils.create_bool_rec_array(len(self.data.f0))
-            new_data.f0 = self.data.f0
+            timestamps = self.data.timestamps
             if operation == 'gte':
-                new_data.f1 = self.data.f1 >= other
+                values = self.data.values >= other
             elif operation == 'gt':
-                new_data.f1 = self.data.f1 > other
+                values = self.data.values > other
             elif operation == 'lte':
-                new_data.f1 = self.data.f1 <= other
+                values = self.data.values <= other
             elif operation == 'lt':
-                new_data.f1 = self.data.f1 < other
-            return BooleanRange(self.definition, new_data)
+                values = self.data.values < other
+            return BooleanRange(self.definition, timeseries.Series(timestamps, values))
         else:
             raise Exception('Not Implemented')
 
@@ -502,33 +761,33 @@ class Range(object):
             raise Exception('Unsupported input type Range for function {}'.format(function))
 
         if function == 'avg':
-            data_result = numpy.mean(self.data.f1)
-            result = utils.get_result_array(self.data.f0[:1], data_result)
+            data_result = numpy.mean(self.data.values)
+            result = utils.get_result_array(self.data.timestamps[:1], data_result)
             return Range(self.definition, result)
 
         if function == 'max':
-            data_result = numpy.amax(self.data.f1)
-            result = utils.get_result_array(self.data.f0[:1], data_result)
+            data_result = numpy.amax(self.data.values)
+            result = utils.get_result_array(self.data.timestamps[:1], data_result)
             return Range(self.definition, result)
 
         if function == 'min':
-            data_result = numpy.amin(self.data.f1)
-            result = utils.get_result_array(self.data.f0[:1], data_result)
+            data_result = numpy.amin(self.data.values)
+            result = utils.get_result_array(self.data.timestamps[:1], data_result)
             return Range(self.definition, result)
 
         if function == 'count':
-            data_result = len(self.data.f1)
-            result = utils.get_result_array(self.data.f0[:1], data_result)
+            data_result = len(self.data.values)
+            result = utils.get_result_array(self.data.timestamps[:1], data_result)
             return Range(self.definition, result)
 
         if function == 'sum':
-            data_result = numpy.sum(self.data.f1)
-            result = utils.get_result_array(self.data.f0[:1], data_result)
+            data_result = numpy.sum(self.data.values)
+            result = utils.get_result_array(self.data.timestamps[:1], data_result)
             return Range(self.definition, result)
 
         if function == 'rate':
-            new_time = self.data.f0[1:]
-            new_data = numpy.diff(self.data.f1) / numpy.diff(self.data.f0 / 1000)
+            new_time = self.data.timestamps[1:]
+            new_data = numpy.diff(self.data.values) / numpy.diff(self.data.timestamps / 1000)
             result = utils.get_result_array(new_time, new_data)
             return Range(self.definition, result)
 
@@ -548,27 +807,19 @@ class BooleanRange(object):
 
     def __and__(self, other):
         if isinstance(other, BooleanRange):
-            utils.validate_timestamp_matching(self.data.f0, other.data.f0)
-            new_data = utils.create_bool_rec_array(len(self.data.f0))
-            try:
-                new_data.f0 = self.data.f0
-                new_data.f1 = numpy.logical_and(self.data.f1, other.data.f1)
-            except ValueError:
-                raise Exception('Cannot combine uneven ranges')
-            return BooleanRange(self.definition, new_data)
+            left, other_values = _asof_join(self.data, other.data, BOOLEAN_JOIN_INTERPOLATION)
+            timestamps = left.timestamps
+            values = numpy.logical_and(left.values, other_values)
+            return BooleanRange(self.definition, timeseries.Series(timestamps, values))
         else:
             raise Exception('Not Implemented')
 
     def __or__(self, other):
         if isinstance(other, BooleanRange):
-            utils.validate_timestamp_matching(self.data.f0, other.data.f0)
-            new_data = utils.create_bool_rec_array(len(self.data.f0))
-            try:
-                new_data.f0 = self.data.f0
-                new_data.f1 = numpy.logical_or(self.data.f1, other.data.f1)
-            except ValueError:
-                raise Exception('Cannot combine uneven ranges')
-            return BooleanRange(self.definition, new_data)
+            left, other_values = _asof_join(self.data, other.data, BOOLEAN_JOIN_INTERPOLATION)
+            timestamps = left.timestamps
+            values = numpy.logical_or(left.values, other_values)
+            return BooleanRange(self.definition, timeseries.Series(timestamps, values))
         else:
             raise Exception('Not Implemented')
 
@@ -577,9 +828,26 @@ class BooleanRange(object):
             raise Exception('Unexpected input type boolean range for function {}'.format(function))
 
         if function == 'any':
-            return numpy.any(self.data.f1)
+            return numpy.any(self.data.values)
         if function == 'all':
-            return numpy.all(self.data.f1)
+            return numpy.all(self.data.values)
 
     def __repr__(self):
         return str(self.definition) + '\n' + str(self.data.tolist())
+
+
+def shift_time(result, shift_ms):
+    """A result with all its timestamps moved by shift_ms, anything else as it is."""
+    if isinstance(result, (AlignedVectorRange, AlignedBooleanVectorRange)):
+        return type(result)(result.definitions, utils.shift_timestamps(result.timestamps, shift_ms),
+                            result.values, result.mask)
+    elif isinstance(result, (VectorRange, BooleanVectorRange)):
+        return type(result)([shift_time(data, shift_ms) for data in result.data])
+    elif isinstance(result, (Range, BooleanRange)):
+        return type(result)(result.definition,
+                            timeseries.Series(utils.shift_timestamps(result.data.timestamps, shift_ms),
+                                              result.data.values))
+    elif isinstance(result, (BinnedRange, BooleanBinnedRange)):
+        return type(result)(result.definition, utils.shift_timestamps(result.bins, shift_ms),
+                            utils.shift_timestamps(result.timestamps, shift_ms), result.values, result.offsets)
+    return result
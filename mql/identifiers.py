@@ -0,0 +1,44 @@
+import re
+
+import pyparsing
+
+# Character classes for metric names, dimension names and dimension values,
+# used by the MQL and AQL grammars and the hand written MQL parser.
+#
+# Identifiers take every ASCII letter, digit and ".-_#$%&'*+/:;?@[\]^`|", plus
+# every non-space code point from U+0080 up. Building that set as a string of
+# ~65k characters for pyparsing.Word dominated import time, so the set is
+# expressed as its complement in a regex character class instead: everything
+# that is not whitespace, a control character or grammar punctuation.
+IDENTIFIER_CHAR = u'[^\\s!"(),<=>{}~\\x00-\\x1f\\x7f]'
+
+# dimension names and values may also contain plain spaces
+DIMENSION_CHAR = u'(?:' + IDENTIFIER_CHAR + u'| )'
+
+MAX_IDENTIFIER_LENGTH = 255
+
+
+def word_pattern(body_char, init_char=None, max_length=MAX_IDENTIFIER_LENGTH):
+    """Regex equivalent of pyparsing.Word(init_char, body_char, min=1, max=max_length).
+
+    As with Word, a run of body characters longer than max_length does not match.
+    """
+    if init_char is None:
+        init_char = body_char
+    return (init_char + body_char + u'{0,' + str(max_length - 1) + u'}' +
+            u'(?!' + body_char + u')')
+
+
+METRIC_NAME_PATTERN = word_pattern(IDENTIFIER_CHAR, init_char=u'[A-Za-z]')
+DIMENSION_WORD_PATTERN = word_pattern(DIMENSION_CHAR)
+
+metric_name_re = re.compile(METRIC_NAME_PATTERN, re.UNICODE)
+dimension_word_re = re.compile(DIMENSION_WORD_PATTERN, re.UNICODE)
+
+
+def metric_name():
+    return pyparsing.Regex(METRIC_NAME_PATTERN, re.UNICODE).setName('metric name')
+
+
+def dimension_word():
+    return pyparsing.Regex(DIMENSION_WORD_PATTERN, re.UNICODE).setName('dimension word')
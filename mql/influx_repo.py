@@ -1,17 +1,279 @@
+import collections
 import datetime
+import random
 import sys
+import threading
+import time
 
 import numpy
+import requests
 from influxdb import client
+from influxdb import exceptions
 
 import mql_parser
+import streaming
+import timeseries
+import utils
 
-influxdb_client = client.InfluxDBClient(
-    "192.168.10.6", "8086",
-    "", "",
-    "mon")
+# errors worth another attempt, anything else (bad query, auth) is raised at once
+RETRY_ERRORS = (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                exceptions.InfluxDBServerError)
 
 
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _result_bytes(results):
+    if isinstance(results, dict):
+        return sum(_result_bytes(aggregate_results) for aggregate_results in results.values())
+    return sum(data.nbytes for key, data in results)
+
+
+def _map_series(results, convert):
+    if isinstance(results, dict):
+        return dict((function, _map_series(aggregate_results, convert))
+                    for function, aggregate_results in results.items())
+    return [(key, convert(data)) for key, data in results]
+
+
+def align_time(timestamp, step_sec):
+    """Round a naive UTC datetime down to a multiple of step_sec."""
+    seconds = (timestamp - _EPOCH).total_seconds()
+    return _EPOCH + datetime.timedelta(seconds=seconds - seconds % step_sec)
+
+
+class ResultCache(object):
+    """Bounded, thread-safe LRU cache of decoded query results, with expiry.
+
+    The size is counted in bytes of the cached arrays. Windows ending less
+    than ingest_lag_sec ago may still receive points and expire after
+    recent_ttl_sec, older windows only after historical_ttl_sec. Results
+    are handed out shared, callers must not modify them.
+
+    With align_sec set, query windows are snapped down to multiples of it,
+    so refreshes within a step share entries. That moves the window, so it
+    is left off unless asked for.
+
+    With compact set, series are stored as timeseries.CompactSeries, in
+    about half the memory but with values rounded to float32, and
+    expanded again on every hit.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, recent_ttl_sec=10, historical_ttl_sec=3600,
+                 ingest_lag_sec=300, align_sec=None, compact=False):
+        self.max_bytes = max_bytes
+        self.compact = compact
+        self.recent_ttl_sec = recent_ttl_sec
+        self.historical_ttl_sec = historical_ttl_sec
+        self.ingest_lag_sec = ingest_lag_sec
+        # step to snap query windows to so refreshes share entries, or None
+        self.align_sec = align_sec
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def ttl(self, end_time, now=None):
+        if now is None:
+            now = datetime.datetime.utcnow()
+        if end_time is not None and end_time < now - datetime.timedelta(seconds=self.ingest_lag_sec):
+            return self.historical_ttl_sec
+        return self.recent_ttl_sec
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            results, size, expires_at = entry
+            if expires_at <= time.time():
+                self.bytes -= size
+                self.misses += 1
+                self.expirations += 1
+                return None
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+        if self.compact:
+            return _map_series(results, timeseries.expand)
+        return results
+
+    def put(self, key, results, end_time):
+        if self.compact:
+            results = _map_series(results, timeseries.compact)
+        size = _result_bytes(results)
+        if size > self.max_bytes:
+            return
+        expires_at = time.time() + self.ttl(end_time)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+            self._entries[key] = (results, size, expires_at)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                evicted = self._entries.popitem(last=False)[1]
+                self.bytes -= evicted[1]
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._entries),
+                    'bytes': self.bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# shared by every repository unless told otherwise
+result_cache = ResultCache()
+
+
+class InfluxRepository(object):
+    """Runs queries against one InfluxDB database, safe to share across threads.
+
+    Requests go through a bounded pool of keep-alive connections, callers
+    wait for a free connection once pool_size are in use. Every request has
+    a timeout and failed connections, timeouts and server errors are retried
+    with exponential backoff and jitter. Results go through `cache` unless
+    it is None, kept apart from those of repositories on other databases
+    sharing it.
+
+    With a chunk_size, aggregates and bucketed rates are computed from the
+    raw points streamed in chunks of that many points instead, so only a
+    chunk is held in memory however long the range, see streaming.aggregate.
+    """
+
+    def __init__(self, host='192.168.10.6', port=8086, username='', password='', database='mon',
+                 pool_size=10, timeout_sec=30, retries=3, backoff_sec=0.1, max_backoff_sec=5,
+                 cache=result_cache):
+        self.cache = cache
+        # cache keys are statements, which do not say where they ran
+        self._cache_scope = (host, port, database)
+        self.retries = retries
+        self.backoff_sec = backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+
+        # retries are handled here, a single attempt per call to the client
+        self._client = client.InfluxDBClient(host, port, username, password, database,
+                                             timeout=timeout_sec, retries=1, pool_size=pool_size)
+        # the client mounts a non-blocking adapter of its own, replace it
+        # afterwards so callers wait for a connection instead of opening more
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self._client._session.mount('http://', adapter)
+        self._client._session.mount('https://', adapter)
+
+    def _backoff(self, attempt):
+        return min(self.max_backoff_sec, self.backoff_sec * 2 ** attempt) * random.random()
+
+    def _with_retries(self, request):
+        attempt = 0
+        while True:
+            try:
+                return request()
+            except RETRY_ERRORS:
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+
+    def execute(self, statement):
+        return self._with_retries(lambda: self._client.query(statement, epoch='ms'))
+
+    def execute_chunked(self, statement, chunk_size):
+        """Run statement, returning a generator of one ResultSet per chunk of points.
+
+        Only sending the request is retried, a response that fails midway raises.
+        """
+        return self._with_retries(
+            lambda: self._client.query(statement, epoch='ms', chunked=True, chunk_size=chunk_size))
+
+    def align_window(self, start_time, end_time):
+        """The window query fetches for the one asked for."""
+        if self.cache is not None and self.cache.align_sec is not None:
+            # snapped windows give the same statement, which keys the cache
+            if start_time is not None:
+                start_time = align_time(start_time, self.cache.align_sec)
+            if end_time is not None:
+                end_time = align_time(end_time, self.cache.align_sec)
+        return start_time, end_time
+
+    def query(self, name, dimensions, function=None, start_time=None, end_time=None, group_by=None,
+              bucket_size=None, arithmetic=None, chunk_size=None):
+        start_time, end_time = self.align_window(start_time, end_time)
+        stream = chunk_size is not None and streaming.can_stream(function, bucket_size)
+        if stream:
+            statement = build_query(name, dimensions, None, start_time, end_time, group_by)
+            # the raw statement is shared by every aggregate streamed from it
+            key = (self._cache_scope, statement, tuple(function) if isinstance(function, list) else function,
+                   bucket_size, arithmetic)
+        else:
+            statement = build_query(name, dimensions, function, start_time, end_time, group_by, bucket_size,
+                                    arithmetic)
+            key = (self._cache_scope, statement)
+        if self.cache is not None:
+            results = self.cache.get(key)
+            if results is not None:
+                return results
+
+        print(statement)
+        if stream:
+            results = streaming.aggregate(self.execute_chunked(statement, chunk_size), function,
+                                          start_time, end_time, bucket_size, arithmetic)
+        else:
+            influx_data = self.execute(statement)
+            # several aggregates come back as {function: results}
+            if isinstance(function, (list, tuple)):
+                results = dict((aggregate, parse_influx_results(influx_data, aggregate))
+                               for aggregate in function)
+            else:
+                results = parse_influx_results(influx_data)
+        if self.cache is not None:
+            self.cache.put(key, results, end_time)
+        return results
+
+
+_repository = None
+_repository_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    """Replace the repository used by query(), see InfluxRepository for the options."""
+    global _repository
+    repository = InfluxRepository(**kwargs)
+    with _repository_lock:
+        _repository = repository
+    return repository
+
+
+def get_repository():
+    global _repository
+    with _repository_lock:
+        if _repository is None:
+            _repository = InfluxRepository()
+        return _repository
+
 
 functions_for_repo = {
     'avg': 'mean',
@@ -22,6 +284,9 @@ functions_for_repo = {
     'rate': 'derivative'
 }
 
+# aggregates that can be requested together in one statement, see build_query
+aggregate_functions = {'mean', 'max', 'min', 'count', 'sum'}
+
 # class Range(object):
 #     def __init__(self, name, dimensions, values):
 #         self.name = name
@@ -49,8 +314,71 @@ def _single_quote(string):
     return "'" + string + "'"
 
 
-def query(name, dimensions, function=None, start_time=None, end_time=None, group_by=None,
-          bucket_size=None):
+def _number(number):
+    if number < 0:
+        return '(' + repr(number) + ')'
+    return repr(number)
+
+
+def _apply_arithmetic(column, arithmetic):
+    # (operator, number, number_first) steps, innermost first
+    for operator, number, number_first in arithmetic or ():
+        if number_first:
+            column = '({} {} {})'.format(_number(number), operator, column)
+        else:
+            column = '({} {} {})'.format(column, operator, _number(number))
+    return column
+
+
+def _select_clause(function, arithmetic=None):
+    if function is None:
+        if arithmetic:
+            return _apply_arithmetic('value', arithmetic) + ' as value'
+        return 'value'
+    if isinstance(function, (list, tuple)):
+        # one column per aggregate, named after it
+        return ', '.join('{} as {}'.format(_apply_arithmetic(name + '(value)', arithmetic), name)
+                         for name in function)
+    return _apply_arithmetic(function + '(value)', arithmetic) + ' as value'
+
+
+def _time_clauses(start_time, end_time):
+    # the end is left out, so a window ending on a bucket boundary does not
+    # open one more bucket for the points right on it
+    clauses = []
+    if start_time is not None:
+        clauses.append('time >= \'' + start_time.isoformat() + 'Z\'')
+    if end_time is not None:
+        clauses.append('time < \'' + end_time.isoformat() + 'Z\'')
+    return clauses
+
+
+def _group_by_time(group_by, bucket_size):
+    time_str = 'time(' + str(bucket_size) + 's)'
+    if isinstance(group_by, list):
+        return group_by + [time_str]
+    return [time_str]
+
+
+def build_derivative_query(name, dimensions, start_time, end_time, group_by, bucket_size, arithmetic=None):
+    # derivative cannot be grouped by time itself, average the per point
+    # rates of a subquery per bucket instead
+    inner_query = build_query(name, dimensions, 'derivative', start_time, end_time, group_by)
+    return "Select {} from ({}) where {} group by {}".format(
+        _select_clause('mean', arithmetic),
+        inner_query.strip(),
+        ' and '.join(_time_clauses(start_time, end_time)),
+        ','.join(_group_by_time(group_by, bucket_size)))
+
+
+def build_query(name, dimensions, function=None, start_time=None, end_time=None, group_by=None,
+                bucket_size=None, arithmetic=None):
+    # function is a single function or a list of aggregate_functions,
+    # arithmetic the scalar steps applied to its result, see _apply_arithmetic
+    if function == 'derivative' and bucket_size is not None:
+        return build_derivative_query(name, dimensions, start_time, end_time, group_by, bucket_size,
+                                      arithmetic)
+
     base_query = "Select {value} from \"{metric_name}\" " \
                  "{where_clause} " \
                  "{group_by} {limit}"
@@ -82,43 +410,59 @@ def query(name, dimensions, function=None, start_time=None, end_time=None, group
 
     # add bucket size to group_by if exists
     if function is not None and bucket_size is not None:
-        time_str = 'time(' + str(bucket_size) + 's)'
-        if isinstance(group_by, list):
-            group_by.append(time_str)
-        else:
-            group_by = [time_str]
+        group_by = _group_by_time(group_by, bucket_size)
 
-    if start_time is not None:
-        where_clauses.append('time >= \'' + start_time.isoformat() + 'Z\'')
-    if end_time is not None:
-        where_clauses.append('time <= \'' + end_time.isoformat() + 'Z\'')
+    where_clauses.extend(_time_clauses(start_time, end_time))
 
     final_query = base_query.format(
-        value=function + '(value) as value' if function is not None else 'value',
+        value=_select_clause(function, arithmetic),
         metric_name=metric_name,
         where_clause=' where ' + " and ".join(where_clauses) if where_clauses else "",
         group_by=' group by ' + ','.join(group_by) if group_by is not None else "",
         limit=" limit " + str(limit) if limit is not None else ""
     )
 
-    print(final_query)
+    return final_query
+
+
+def query(name, dimensions, function=None, start_time=None, end_time=None, group_by=None,
+          bucket_size=None, arithmetic=None, chunk_size=None):
+    return get_repository().query(name, dimensions, function, start_time, end_time, group_by, bucket_size,
+                                  arithmetic, chunk_size)
+
+
+def align_window(start_time, end_time):
+    return get_repository().align_window(start_time, end_time)
+
+
+def parse_series_columns(series, column='value'):
+    """Decode the time and given column of one raw series into a Series.
 
-    return parse_influx_results(influxdb_client.query(final_query, epoch='ms'))
+    Each column goes from the JSON values straight into an array of its
+    type, points without a value are dropped with a single mask.
+    """
+    columns = series['columns']
+    rows = series.get('values') or []
+    if not rows:
+        return timeseries.empty(0)
+    time_index = columns.index('time')
+    value_index = columns.index(column)
+    timestamps = numpy.fromiter((row[time_index] for row in rows), dtype=timeseries.TIMESTAMP_DTYPE,
+                                count=len(rows))
+    # a missing value, None, decodes as nan
+    values = numpy.fromiter((row[value_index] for row in rows), dtype=numpy.float64, count=len(rows))
+    present = ~numpy.isnan(values)
+    if not present.all():
+        timestamps, values = timestamps[present], values[present]
+    return timeseries.Series(timestamps, values)
 
 
-def parse_influx_results(influx_data):
-    # print(influx_data)
+def parse_influx_results(influx_data, column='value'):
+    # keys as ResultSet.keys(), (measurement, tags)
     results = []
-    definitions = {}
-    for key, series in influx_data.items():
-        key_str = str(key)
-        definitions[key_str] = key
-        time_series = []
-        for point in influx_data[key]:
-            if point['value'] is None:
-                continue
-            time_series.append((point['time'], point['value']))
-        results.append((key, numpy.rec.array(time_series)))
+    for series in influx_data.raw.get('series', []):
+        key = (series.get('name', 'results'), series.get('tags', None))
+        results.append((key, parse_series_columns(series, column)))
     return results
 
 
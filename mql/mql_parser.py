@@ -1,10 +1,18 @@
+import collections
+import copy
 import datetime
 import sys
+import threading
 import time
 
+import numpy
 import pyparsing
 
-from query_structures import (Dimension,
+import identifiers
+from query_structures import (EvaluationContext,
+                              prefetch,
+                              push_down,
+                              Dimension,
                               RangeSelector,
                               OffsetSelector,
                               MetricSelector,
@@ -12,6 +20,9 @@ from query_structures import (Dimension,
                               Expression,
                               BooleanExpression,
                               LogicalExpression)
+from data_types import VectorRange, BooleanVectorRange, BinnedRange
+import pratt_parser
+import program
 
 COMMA = pyparsing.Suppress(pyparsing.Literal(","))
 LPAREN = pyparsing.Suppress(pyparsing.Literal("("))
@@ -28,18 +39,10 @@ decimal_number = (pyparsing.Optional(MINUS) + integer_number +
                   pyparsing.Optional("." + integer_number))
 decimal_number.setParseAction(lambda tokens: float("".join(tokens)))
 
-# Initialize non-ascii unicode code points in the Basic Multilingual Plane.
-unicode_printables = u''.join(
-    unichr(c) for c in range(128, 65536) if not unichr(c).isspace())
-
 # Does not like comma. No Literals from above allowed.
-valid_identifier_chars = (
-    (unicode_printables + pyparsing.alphanums + ".-_#$%&'*+/:;?@[\\]^`|"))
-
-metric_name = (
-    pyparsing.Word(pyparsing.alphas, valid_identifier_chars, min=1, max=255)("metric_name"))
-dimension_name = pyparsing.Word(valid_identifier_chars + ' ', min=1, max=255)
-dimension_value = pyparsing.Word(valid_identifier_chars + ' ', min=1, max=255)
+metric_name = identifiers.metric_name()("metric_name")
+dimension_name = identifiers.dimension_word()
+dimension_value = identifiers.dimension_word()
 
 dim_comparison_op = pyparsing.oneOf("= != =~ !~")
 
@@ -121,116 +124,471 @@ logical_expression << pyparsing.infixNotation(logical_sub_expression,
                                               (logical_or, 2, pyparsing.opAssoc.LEFT, LogicalExpression)])
 
 # order matters, put longer first
-grammar = (boolean_function_stmt | logical_expression | expression)
+# a bare boolean function is tried first as a shortcut, it has to span the
+#  whole input or it would shadow logical expressions that start with one
+grammar = (boolean_function_stmt + pyparsing.StringEnd() | logical_expression | expression)
+
+# bound on the number of memoized (element, location) results kept per parse
+PACKRAT_CACHE_SIZE = 512
+
+
+def enable_packrat(cache_size_limit=PACKRAT_CACHE_SIZE):
+    """Opt in to pyparsing's memoizing (packrat) parser.
+
+    This is a process wide pyparsing switch and cannot be turned back off,
+    so it is left to the caller rather than enabled on import. Compare both
+    modes with benchmark() before turning it on.
+    """
+    pyparsing.ParserElement.enablePackrat(cache_size_limit=cache_size_limit)
+
+
+def packrat_enabled():
+    return pyparsing.ParserElement._packratEnabled
+
+
+def _parse_with_grammar(expr):
+    return grammar.parseString(expr, parseAll=True)
+
+
+# interchangeable parser implementations, both produce the same tree
+parse_backends = {
+    'pyparsing': _parse_with_grammar,
+    'pratt': pratt_parser.parse
+}
+
+
+class ParseCache(object):
+    """Bounded, thread-safe LRU cache of parse results keyed on backend and expression text.
+
+    Entries are never handed out directly, every hit returns a deep copy so
+    callers cannot share selector state through the cache.
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            parse_result = self._entries.pop(key, None)
+            if parse_result is None:
+                self.misses += 1
+                return None
+            # re-insert to mark as most recently used
+            self._entries[key] = parse_result
+            self.hits += 1
+        return copy.deepcopy(parse_result)
+
+    def put(self, key, parse_result):
+        if self.max_size <= 0:
+            return
+        parse_result = copy.deepcopy(parse_result)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = parse_result
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries),
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# threads fetching the selectors of one query, keep at or below the
+# connection pool size of the repository
+PREFETCH_WORKERS = 8
+
+
+class PreparedQuery(object):
+    """An expression parsed once and evaluated any number of times.
+
+    Nothing in the tree depends on the time it was parsed at, the time window
+    of every selector is bound when `evaluate` is called. `stats` holds the
+    database fetches made and saved by the last evaluation.
+
+    An incremental query keeps the fetched windows between evaluations and
+    only fetches what is newer than lag_sec before the previous run, for
+    queries evaluated again and again with a moving `now`.
+
+    `align` is 'bucket' or a step in seconds to snap selector windows to,
+    see MetricSelector.window. `push_down_rate` has InfluxDB average the
+    rates of bucketed ranges, `rewrite` moves scalar arithmetic and range
+    thresholds into the statements, see query_structures.push_down.
+    `stream_chunk_size` aggregates long ranges here from chunked raw
+    fetches, see EvaluationContext. The tree is compiled once into a
+    program.Program, which every evaluation runs.
+    """
+
+    def __init__(self, expr, tree, incremental=False, lag_sec=60, align=None, push_down_rate=True,
+                 rewrite=True, stream_chunk_size=None):
+        self.expr = expr
+        self.tree = push_down(tree) if rewrite else tree
+        self.program = program.compile_tree(self.tree)
+        self.stats = None
+        self.lag_sec = lag_sec
+        self.align = align
+        self.push_down_rate = push_down_rate
+        self.stream_chunk_size = stream_chunk_size
+        self.windows = {} if incremental else None
+
+    def evaluate(self, now=None, max_workers=PREFETCH_WORKERS):
+        # selectors are fetched concurrently first, max_workers=1 fetches
+        # them one after the other
+        context = EvaluationContext(now, self.windows, self.lag_sec, self.align, self.push_down_rate,
+                                    self.stream_chunk_size)
+        if hasattr(self.tree, 'evaluate'):
+            prefetch(self.tree, context, max_workers)
+            result = self.program.evaluate(context=context)
+        else:
+            result = self.tree
+        self.stats = {'fetches': context.fetches, 'fetches_saved': context.fetches_saved}
+        return result
+
+    def __repr__(self):
+        return "PreparedQuery(expr='{}',tree={})".format(self.expr, self.tree)
+
+
+class PreparedBatch(object):
+    """Many expressions evaluated together over one fetch plan.
+
+    The selectors of every expression are planned as one: a selector used
+    by several expressions is fetched once, and selectors on one metric and
+    window that only differ in their dimension values share a statement,
+    see query_structures.SharedSelector. Each expression is then reduced
+    over the shared results.
+
+    Takes the same options as PreparedQuery. `stats` holds the number of
+    expressions, the fetches made and saved and the wall time of the last
+    evaluation.
+    """
+
+    def __init__(self, exprs, trees, incremental=False, lag_sec=60, align=None, push_down_rate=True,
+                 rewrite=True, stream_chunk_size=None):
+        self.exprs = exprs
+        self.trees = [push_down(tree) if rewrite and not isinstance(tree, Exception) else tree for tree in trees]
+        self.programs = [program.compile_tree(tree) for tree in self.trees]
+        self.stats = None
+        self.lag_sec = lag_sec
+        self.align = align
+        self.push_down_rate = push_down_rate
+        self.stream_chunk_size = stream_chunk_size
+        self.windows = {} if incremental else None
+
+    def evaluate(self, now=None, max_workers=PREFETCH_WORKERS):
+        """Results in the order of the expressions.
+
+        An expression that fails to parse or evaluate, or whose selectors
+        failed to fetch, has its exception in place of a result, the others
+        are still evaluated.
+        """
+        start_time = time.time()
+        context = EvaluationContext(now, self.windows, self.lag_sec, self.align, self.push_down_rate,
+                                    self.stream_chunk_size)
+        prefetch([tree for tree in self.trees if hasattr(tree, 'evaluate')], context, max_workers)
+        results = []
+        for tree, tree_program in zip(self.trees, self.programs):
+            # a number, or the exception the expression failed to parse with
+            if not hasattr(tree, 'evaluate'):
+                results.append(tree)
+                continue
+            try:
+                results.append(tree_program.evaluate(context=context))
+            except Exception as ex:
+                results.append(ex)
+        self.stats = {'expressions': len(self.trees), 'fetches': context.fetches,
+                      'fetches_saved': context.fetches_saved, 'wall_time_sec': time.time() - start_time}
+        return results
+
+    def __len__(self):
+        return len(self.trees)
+
+    def __repr__(self):
+        return "PreparedBatch(expressions={})".format(len(self.trees))
+
+
+# shared by every MQLParser unless told otherwise
+parse_cache = ParseCache()
 
 
 class MQLParser(object):
-    def __init__(self, expr):
+    def __init__(self, expr, cache=None, use_cache=True, backend='pyparsing'):
+        if backend not in parse_backends:
+            raise ValueError('Unknown parser backend \'{}\''.format(backend))
         self._expr = expr
+        self._backend = backend
+        self._parse = parse_backends[backend]
+        self._cache = None
+        if use_cache:
+            self._cache = cache if cache is not None else parse_cache
 
     def parse(self):
-        parse_result = grammar.parseString(self._expr, parseAll=True)
-        return parse_result
+        if self._cache is not None:
+            parse_result = self._cache.get((self._backend, self._expr))
+            if parse_result is not None:
+                return parse_result
 
+        parse_result = self._parse(self._expr)
 
-def main():
+        if self._cache is not None:
+            self._cache.put((self._backend, self._expr), parse_result)
+        return parse_result
 
-    expression_list = [
-        # test metric parsing
-        "net.in_bytes_sec",
-        "net.in_bytes_sec{}",
-        "net.in_bytes_sec{hostname=dev}",
-        "net.in_bytes_sec{hostname=~dev, testing=testing}",
-        "{hostname!~testing, testing!=hostname}",
-        "{hostname=dev, testing!=testing}",
-        "{host name=testing}",
-        "{22=34, 45!=1}",
-
-        # test function parsing
-        "max(2)",
-        "avg(net.in_bytes_sec)",
-        "max(net.in_bytes_sec{})",
-        "count(min(2.1))",
-        "max(avg(net.in_bytes_sec))",
-        "(avg(latency) - latency_threshold) + 22",
-
-        # test range
-        "net.in_bytes_sec [5m]",
-        "avg(net.out_bytes_sec [2w])",
-        "max(avg(test_metric [1s]))",
-
-        # test range with offset
-        "net.in_bytes_sec offset 1w",
-        "net.in_bytes_sec offset 2017-01-01T13:10:12.001Z",
-        "net.in_bytes_sec [5m] offset 1w",
-        "net.in_bytes_sec [5m] offset 2017-01-01T13:10:12.001Z",
-
-        # test range with grouping
-        "net.in_bytes_sec [1m over 15m]",
-        "avg(net.out_bytes_sec [10m over 1h])",
-        "net.in_bytes_sec [5m over 1d] + net.out_bytes_sec [5m over 1d]",
-
-        # test range with grouping and offset
-        "net.in_bytes_sec [1m over 15m] offset 1w",
-        "avg(net.out_bytes_sec [10m over 1h] offset 2017-01-01T13:13:13.102Z)",
-        "net.in_bytes_sec [5m over 1d] offset 2016-01-01T01:01:01.001Z + net.out_bytes_sec [5m over 1d] offset 1w",
-
-        # test multiple statements
-        "net.in_bytes_sec + net.out_bytes_sec",
-        "avg(net.in_bytes_sec) / max(net.out_bytes_sec)",
-        "net.in_bytes_sec [5m] * net.out_bytes_sec [5s]",
-        "avg(net.in_bytes_sec [5m]) / avg(net.out_bytes_sec [5m over 1h])",
-        "min(net.in_bytes_sec) + avg(net.in_bytes_sec) + max(net.in_bytes_sec)",
-
-        # test statements nested inside functions
-        "avg(net.in_bytes_sec - net.out_bytes_sec)",
-        "avg(net.in_bytes_sec - net.out_bytes_sec) - count(test_metric)",
-        "sum(avg(net.out_bytes_sec) - avg(net.in_bytes_sec) / count(net.total_bytes_sec))",
-
-        # test boolean expressions
-        "net.in_bytes_sec > 5000",
-        "net.in_bytes_sec > net.out_bytes_sec",
-        "avg(net.in_bytes_sec) <= avg(net.out_bytes_sec)",
-        "max(net.in_bytes_sec [5m]) >= max(net.out_bytes_sec [5m] offset 1d)",
-        "5 lt 10",
-        "net.out_bytes_sec gte test_metric",
-
-        # test logical expressions
-        "net.in_bytes_sec > net.out_bytes_sec or net.in_bytes_sec < net.out_bytes_sec",
-        "avg(net.in_bytes_sec [17m]) >= test_metric || min(net.out_bytes_sec [1h over 2d]) < test_metric",
-        "test_metric > 1 and test_metric < 2 && avg(test_metric [5m]) < test_metric offset 2016-01-01T01:01:01.001Z",  # Failing to parse completely
-        "(test_metric > 1 or test_metric < 1) and test_metric >= 1",
-        "test_metric > 1 or (test_metric < 1 and test_metric >= 1)",
-        "test_metric > 1 or test_metric < 1 and test_metric < 2",
-
-        # test boolean expression functions
-        "any(test_metric > 1)",
-        "all(test_metric < 10)",
-
-        # test logical expression functions
-        "any(test_metric > 1 and test_metric < 10)",
-        "any(all(test_metric [5m over 15m] > 1))"
-    ]
+    def prepare(self, incremental=False, lag_sec=60, align=None, push_down_rate=True, rewrite=True,
+                stream_chunk_size=None):
+        return PreparedQuery(self._expr, self.parse()[0], incremental, lag_sec, align, push_down_rate, rewrite,
+                             stream_chunk_size)
 
-    negative_expression_list = [
-        # test invalid metric names
-        "22{hostname=test-01}",
-        "2a3{hostname=test-02}",
 
-        # test invalid symbol/operator use
-        "test_metric // 22",
-        "test_metric >> 22",
-        "test_metric > and test_metric < 2",
-        "14 < net.in_bytes < 25",
+def prepare_batch(exprs, incremental=False, lag_sec=60, align=None, push_down_rate=True, rewrite=True,
+                  stream_chunk_size=None, backend='pyparsing'):
+    """Parse every expression and prepare them for evaluation together, see PreparedBatch.
 
-        # test timestamp parsing/validation
-        "test_metric offset 2017-01-01",
-        "test_metric offset 2017-01-57T01:01:01.001Z",
+    An expression that fails to parse has its exception in place of a tree,
+    returned as its result by every evaluation.
+    """
+    trees = []
+    for expr in exprs:
+        try:
+            trees.append(MQLParser(expr, backend=backend).parse()[0])
+        except Exception as ex:
+            trees.append(ex)
+    return PreparedBatch(exprs, trees, incremental, lag_sec, align, push_down_rate, rewrite, stream_chunk_size)
+
+
+def batch_main(path, now=None):
+    """Evaluate the expressions of a file, one per line, as one batch and print its stats."""
+    with open(path) as expr_file:
+        exprs = [line.strip() for line in expr_file if line.strip()]
+    batch = prepare_batch(exprs)
+    results = batch.evaluate(now)
+    failures = 0
+    for expr, result in zip(exprs, results):
+        if isinstance(result, Exception):
+            failures += 1
+            print("Failed '{}': {}".format(expr, result))
+    print("Batch of {expressions} expressions: {fetches} fetches, {fetches_saved} saved, "
+          "{wall_time_sec:.3f}s".format(**batch.stats))
+    return 1 if failures else 0
+
+
+# positive and negative parsing corpora, shared by main() and benchmark()
+expression_list = [
+    # test metric parsing
+    "net.in_bytes_sec",
+    "net.in_bytes_sec{}",
+    "net.in_bytes_sec{hostname=dev}",
+    "net.in_bytes_sec{hostname=~dev, testing=testing}",
+    "{hostname!~testing, testing!=hostname}",
+    "{hostname=dev, testing!=testing}",
+    "{host name=testing}",
+    "{22=34, 45!=1}",
+
+    # test function parsing
+    "max(2)",
+    "avg(net.in_bytes_sec)",
+    "max(net.in_bytes_sec{})",
+    "count(min(2.1))",
+    "max(avg(net.in_bytes_sec))",
+    "(avg(latency) - latency_threshold) + 22",
+
+    # test range
+    "net.in_bytes_sec [5m]",
+    "avg(net.out_bytes_sec [2w])",
+    "max(avg(test_metric [1s]))",
+
+    # test range with offset
+    "net.in_bytes_sec offset 1w",
+    "net.in_bytes_sec offset 2017-01-01T13:10:12.001Z",
+    "net.in_bytes_sec [5m] offset 1w",
+    "net.in_bytes_sec [5m] offset 2017-01-01T13:10:12.001Z",
+
+    # test range with grouping
+    "net.in_bytes_sec [1m over 15m]",
+    "avg(net.out_bytes_sec [10m over 1h])",
+    "net.in_bytes_sec [5m over 1d] + net.out_bytes_sec [5m over 1d]",
+
+    # test range with grouping and offset
+    "net.in_bytes_sec [1m over 15m] offset 1w",
+    "avg(net.out_bytes_sec [10m over 1h] offset 2017-01-01T13:13:13.102Z)",
+    "net.in_bytes_sec [5m over 1d] offset 2016-01-01T01:01:01.001Z + net.out_bytes_sec [5m over 1d] offset 1w",
+
+    # test multiple statements
+    "net.in_bytes_sec + net.out_bytes_sec",
+    "avg(net.in_bytes_sec) / max(net.out_bytes_sec)",
+    "net.in_bytes_sec [5m] * net.out_bytes_sec [5s]",
+    "avg(net.in_bytes_sec [5m]) / avg(net.out_bytes_sec [5m over 1h])",
+    "min(net.in_bytes_sec) + avg(net.in_bytes_sec) + max(net.in_bytes_sec)",
+
+    # test statements nested inside functions
+    "avg(net.in_bytes_sec - net.out_bytes_sec)",
+    "avg(net.in_bytes_sec - net.out_bytes_sec) - count(test_metric)",
+    "sum(avg(net.out_bytes_sec) - avg(net.in_bytes_sec) / count(net.total_bytes_sec))",
+
+    # test boolean expressions
+    "net.in_bytes_sec > 5000",
+    "net.in_bytes_sec > net.out_bytes_sec",
+    "avg(net.in_bytes_sec) <= avg(net.out_bytes_sec)",
+    "max(net.in_bytes_sec [5m]) >= max(net.out_bytes_sec [5m] offset 1d)",
+    "5 lt 10",
+    "net.out_bytes_sec gte test_metric",
+
+    # test logical expressions
+    "net.in_bytes_sec > net.out_bytes_sec or net.in_bytes_sec < net.out_bytes_sec",
+    "avg(net.in_bytes_sec [17m]) >= test_metric || min(net.out_bytes_sec [1h over 2d]) < test_metric",
+    "test_metric > 1 and test_metric < 2 && avg(test_metric [5m]) < test_metric offset 2016-01-01T01:01:01.001Z",  # Failing to parse completely
+    "(test_metric > 1 or test_metric < 1) and test_metric >= 1",
+    "test_metric > 1 or (test_metric < 1 and test_metric >= 1)",
+    "test_metric > 1 or test_metric < 1 and test_metric < 2",
+
+    # test boolean expression functions
+    "any(test_metric > 1)",
+    "all(test_metric < 10)",
+
+    # test logical expression functions
+    "any(test_metric > 1 and test_metric < 10)",
+    "any(all(test_metric [5m over 15m] > 1))"
+]
+
+negative_expression_list = [
+    # test invalid metric names
+    "22{hostname=test-01}",
+    "2a3{hostname=test-02}",
+
+    # test invalid symbol/operator use
+    "test_metric // 22",
+    "test_metric >> 22",
+    "test_metric > and test_metric < 2",
+    "14 < net.in_bytes < 25",
+
+    # test timestamp parsing/validation
+    "test_metric offset 2017-01-01",
+    "test_metric offset 2017-01-57T01:01:01.001Z",
+
+    # test function inputs
+    "avg(test_metric > 20)",
+    "any(test_metric{hostname=test_host_01})",
+]
+
+
+def benchmark(expressions=None, repeat=10, backend='pyparsing'):
+    """Time uncached parses of every expression in the corpus.
+
+    Returns latency statistics in milliseconds, taken over the best of
+    `repeat` runs of each expression.
+    """
+    if expressions is None:
+        expressions = expression_list
+
+    timings = []
+    for expr in expressions:
+        best = None
+        for _ in range(repeat):
+            start_time = time.time()
+            MQLParser(expr, use_cache=False, backend=backend).parse()
+            elapsed = time.time() - start_time
+            if best is None or elapsed < best:
+                best = elapsed
+        timings.append((best * 1000, expr))
+
+    timings.sort()
+    latencies = [timing[0] for timing in timings]
+    return {'backend': backend,
+            'packrat': packrat_enabled(),
+            'count': len(latencies),
+            'total_ms': sum(latencies),
+            'mean_ms': sum(latencies) / len(latencies),
+            'median_ms': latencies[len(latencies) // 2],
+            'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'max_ms': latencies[-1],
+            'slowest': timings[-1][1]}
+
+
+def _series_by_definition(result):
+    series = {}
+    for serie in result.data:
+        if isinstance(serie, BinnedRange):
+            series[str(serie.definition)] = (serie.timestamps, serie.values)
+        else:
+            series[str(serie.definition)] = (serie.data.timestamps, serie.data.values)
+    return series
+
+
+def compare_results(left, right, rtol=1e-9):
+    """Differences between two evaluation results, as a list of messages."""
+    if not isinstance(left, (VectorRange, BooleanVectorRange)) or type(left) is not type(right):
+        return [] if left == right else ['{} != {}'.format(left, right)]
+    if not all(hasattr(serie, 'definition') for serie in left.data + right.data):
+        # plain values, as any() and all() give
+        return [] if list(left.data) == list(right.data) else ['{} != {}'.format(left.data, right.data)]
+    left_series = _series_by_definition(left)
+    right_series = _series_by_definition(right)
+    differences = ['Only on one side: ' + definition
+                   for definition in sorted(set(left_series) ^ set(right_series))]
+    for definition in sorted(set(left_series) & set(right_series)):
+        left_timestamps, left_values = left_series[definition]
+        right_timestamps, right_values = right_series[definition]
+        if not numpy.array_equal(left_timestamps, right_timestamps):
+            differences.append('Timestamps differ for ' + definition)
+        elif not numpy.allclose(left_values, right_values, rtol=rtol, atol=0):
+            differences.append('Values differ for {}, max difference {}'.format(
+                definition, numpy.max(numpy.abs(left_values - right_values))))
+    return differences
+
+
+def check_pushdown(expr, now=None):
+    """Evaluate expr with and without work pushed down to InfluxDB, print any difference.
+
+    Windows are aligned to the buckets on both sides, so the server side
+    group by time() and the client side bins cover the same intervals.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    tree = MQLParser(expr).parse()[0]
+    pushed_down = PreparedQuery(expr, tree, align='bucket').evaluate(now)
+    client_side = PreparedQuery(expr, tree, align='bucket', push_down_rate=False, rewrite=False).evaluate(now)
+    differences = compare_results(pushed_down, client_side)
+    for difference in differences:
+        print(difference)
+    print("Pushdown for '{}': {}".format(expr, 'differs' if differences else 'consistent'))
+    return 1 if differences else 0
+
+
+def benchmark_main(max_mean_ms=None, packrat=False, backend='pyparsing'):
+    """Print parse latency for the corpus, fail if over the given budget."""
+    if packrat:
+        enable_packrat()
+    result = benchmark(backend=backend)
+    print("Parse latency ({backend}, packrat={packrat}) over {count} expressions: "
+          "mean {mean_ms:.3f}ms, median {median_ms:.3f}ms, p95 {p95_ms:.3f}ms, "
+          "max {max_ms:.3f}ms, total {total_ms:.3f}ms".format(**result))
+    print("Slowest: " + result['slowest'])
+    if max_mean_ms is not None and result['mean_ms'] > max_mean_ms:
+        print("Mean parse latency {:.3f}ms is over the budget of {:.3f}ms".format(
+            result['mean_ms'], max_mean_ms))
+        return 1
+    return 0
 
-        # test function inputs
-        "avg(test_metric > 20)",
-        "any(test_metric{hostname=test_host_01})",
-    ]
+
+def main():
 
     start_time = time.time()
 
@@ -259,6 +617,29 @@ def main():
     total_queries = len(expression_list) + len(negative_expression_list)
     print("Complete {} in {} seconds".format(total_queries, total_time))
 
+    # the hand written backend must build the same trees and reject the same input
+    start_time = time.time()
+    for expr in expression_list:
+        expected = repr(MQLParser(expr).parse()[0])
+        result = repr(MQLParser(expr, use_cache=False, backend='pratt').parse()[0])
+        assert result == expected, "Pratt parse differs for " + expr
+    for expr in negative_expression_list:
+        try:
+            MQLParser(expr, use_cache=False, backend='pratt').parse()
+            assert False, "Pratt parse did not fail for " + expr
+        except (pyparsing.ParseBaseException, ValueError):
+            pass
+    total_time = time.time() - start_time
+    print("Pratt conformance {} in {} seconds".format(total_queries, total_time))
+
+    # second pass should be served from the parse cache
+    start_time = time.time()
+    for expr in expression_list:
+        MQLParser(expr).parse()
+    total_time = time.time() - start_time
+    print("Cached {} in {} seconds".format(len(expression_list), total_time))
+    print(parse_cache.stats())
+
     data_start_time = datetime.datetime.strptime("2017-01-23T16:00:00.000Z", '%Y-%m-%dT%H:%M:%S.%fZ')
     eval_expr_list = [
         # check basic metric results
@@ -281,8 +662,8 @@ def main():
         'cpu.idle_perc [5m] offset ' + data_start_time.isoformat() + '.000Z + ' + \
             'cpu.idle_perc [5m] offset ' + data_start_time.isoformat() + '.000Z',
         'cpu.idle_perc [5m] offset ' + data_start_time.isoformat() + '.000Z * 2 ',
-        # 'cpu.idle_perc [5m] offset ' + data_start_time.isoformat() + '.000Z + ' + \
-        #     'cpu.idle_perc [5m] offset ' + (data_start_time + datetime.timedelta(minutes=5)).isoformat() + '.000Z',
+        'cpu.idle_perc [5m] offset ' + data_start_time.isoformat() + '.000Z + ' + \
+            'cpu.idle_perc [5m] offset ' + (data_start_time + datetime.timedelta(minutes=5)).isoformat() + '.000Z',
         'cpu.idle_perc [5m over 15m] offset ' + data_start_time.isoformat() + '.000Z',
         'cpu.idle_perc [5m over 15m] offset ' + data_start_time.isoformat() + '.000Z + ' + \
             'cpu.idle_perc [5m over 15m] offset ' + data_start_time.isoformat() + '.000Z',
@@ -0,0 +1,233 @@
+import datetime
+import re
+
+import pyparsing
+
+import identifiers
+from query_structures import (Dimension,
+                              RangeSelector,
+                              OffsetSelector,
+                              MetricSelector,
+                              FuncStmt,
+                              Expression,
+                              BooleanExpression,
+                              LogicalExpression)
+
+# Hand written tokenizer and Pratt parser for MQL. It accepts the same language
+# as the pyparsing grammar in mql_parser and builds the same tree, tokens are
+# matched on demand so context decides e.g. whether '-' is an operator or sign.
+
+# pyparsing's default whitespace, also allowed between the parts of a number
+# or time selector
+_WHITESPACE = re.compile(r'[ \t\r\n]*')
+
+_METRIC_NAME = identifiers.metric_name_re
+_DIMENSION_WORD = identifiers.dimension_word_re
+_DIMENSION_OPERATOR = re.compile(r'=~|=|!=|!~')
+
+_NUMBER = re.compile(r'(?:-[ \t\r\n]*)?[0-9]+(?:[ \t\r\n]*\.[ \t\r\n]*[0-9]+)?')
+_TIME_SELECTOR = re.compile(r'([0-9]+)[ \t\r\n]*([smhdw])')
+_ISO_TIMESTAMP = re.compile(r'[0-9TZ\-:.]{24}(?![0-9TZ\-:.])')
+
+_FUNCTION_CALL = re.compile(r'(max|min|avg|count|sum|last|rate)[ \t\r\n]*\(', re.IGNORECASE)
+_BOOLEAN_FUNCTION_CALL = re.compile(r'(any|all)[ \t\r\n]*\(', re.IGNORECASE)
+
+_RELATIONAL_OPERATOR = re.compile(r'<=|>=|<|>|lte|lt|gte|gt', re.IGNORECASE)
+_ARITHMETIC_OPERATOR = re.compile(r'[*/+\-]')
+_LOGICAL_OPERATOR = re.compile(r'and|&&|or|\|\|', re.IGNORECASE)
+
+# left binding power of each infix operator, higher binds tighter
+arithmetic_binding_power = {'*': 2, '/': 2, '+': 1, '-': 1}
+logical_binding_power = {'and': 2, '&&': 2, 'or': 1, '||': 1}
+
+# characters that may not surround a keyword, as pyparsing.Keyword
+_KEYWORD_CHARS = frozenset(pyparsing.alphanums + '_$')
+
+
+def validate_iso_timestamp(timestamp):
+    return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class PrattParser(object):
+    def __init__(self, expr):
+        self._expr = expr
+        self._pos = 0
+
+    def parse(self):
+        try:
+            tree = self._logical_expression()
+        except pyparsing.ParseException:
+            # not a boolean statement, retry as plain arithmetic
+            self._pos = 0
+            tree = self._expression()
+        self._skip()
+        if self._pos != len(self._expr):
+            self._fail('Expected end of text')
+        return [tree]
+
+    def _fail(self, message):
+        raise pyparsing.ParseException(self._expr, self._pos, message)
+
+    def _skip(self):
+        self._pos = _WHITESPACE.match(self._expr, self._pos).end()
+
+    def _match(self, pattern):
+        self._skip()
+        match = pattern.match(self._expr, self._pos)
+        if match is not None:
+            self._pos = match.end()
+        return match
+
+    def _expect(self, pattern, description):
+        match = self._match(pattern)
+        if match is None:
+            self._fail('Expected ' + description)
+        return match.group()
+
+    def _peek(self, char):
+        self._skip()
+        return self._expr.startswith(char, self._pos)
+
+    def _expect_char(self, char):
+        if not self._peek(char):
+            self._fail('Expected "{}"'.format(char))
+        self._pos += 1
+
+    def _keyword(self, keyword):
+        self._skip()
+        end = self._pos + len(keyword)
+        if (self._expr[self._pos:end].lower() != keyword or
+                (end < len(self._expr) and self._expr[end] in _KEYWORD_CHARS) or
+                (self._pos > 0 and self._expr[self._pos - 1] in _KEYWORD_CHARS)):
+            return False
+        self._pos = end
+        return True
+
+    def _infix(self, operand, operators, binding_power, node_type, min_power=1):
+        left = operand()
+        while True:
+            start = self._pos
+            match = self._match(operators)
+            if match is None:
+                return left
+            operator = match.group().lower()
+            power = binding_power[operator]
+            if power < min_power:
+                self._pos = start
+                return left
+            # left associative, the right side only takes tighter operators
+            right = self._infix(operand, operators, binding_power, node_type, power + 1)
+            left = node_type([[left, operator, right]])
+
+    def _expression(self):
+        return self._infix(self._operand, _ARITHMETIC_OPERATOR, arithmetic_binding_power, Expression)
+
+    def _logical_expression(self):
+        return self._infix(self._logical_operand, _LOGICAL_OPERATOR, logical_binding_power, LogicalExpression)
+
+    def _operand(self):
+        function = self._match(_FUNCTION_CALL)
+        if function is not None:
+            operand = self._expression()
+            self._expect_char(')')
+            return FuncStmt([function.group(1).lower(), operand])
+
+        if self._peek('('):
+            self._pos += 1
+            result = self._expression()
+            self._expect_char(')')
+            return result
+
+        number = self._match(_NUMBER)
+        if number is not None:
+            return float(''.join(number.group().split()))
+
+        return self._metric_selector()
+
+    def _logical_operand(self):
+        function = self._match(_BOOLEAN_FUNCTION_CALL)
+        if function is not None:
+            operand = self._logical_expression()
+            self._expect_char(')')
+            return FuncStmt([function.group(1).lower(), operand])
+
+        if self._peek('('):
+            # either the left side of a comparison or a grouped logical expression
+            start = self._pos
+            try:
+                return self._boolean_expression()
+            except pyparsing.ParseException:
+                self._pos = start + 1
+            result = self._logical_expression()
+            self._expect_char(')')
+            return result
+
+        return self._boolean_expression()
+
+    def _boolean_expression(self):
+        left = self._expression()
+        operator = self._expect(_RELATIONAL_OPERATOR, 'relational operator').lower()
+        right = self._expression()
+        return BooleanExpression([left, operator, right])
+
+    def _metric_selector(self):
+        tokens = []
+        name = self._match(_METRIC_NAME)
+        if name is not None:
+            tokens.append(name.group())
+
+        if self._peek('{'):
+            tokens.append(self._dimension_list())
+        elif name is None:
+            self._fail('Expected metric name or dimensions')
+
+        if self._peek('['):
+            tokens.append(self._range_selector())
+
+        if self._keyword('offset'):
+            tokens.append(self._offset_selector())
+
+        return MetricSelector(tokens)
+
+    def _dimension_list(self):
+        self._pos += 1
+        dimensions = []
+        if not self._peek('}'):
+            dimensions.append(self._dimension())
+            while self._peek(','):
+                self._pos += 1
+                dimensions.append(self._dimension())
+        self._expect_char('}')
+        return dimensions
+
+    def _dimension(self):
+        key = self._expect(_DIMENSION_WORD, 'dimension name')
+        operator = self._expect(_DIMENSION_OPERATOR, 'dimension operator')
+        value = self._expect(_DIMENSION_WORD, 'dimension value')
+        return Dimension([key, operator, value])
+
+    def _time_selector(self):
+        match = self._match(_TIME_SELECTOR)
+        if match is None:
+            self._fail('Expected time selector')
+        return match.group(1) + match.group(2)
+
+    def _range_selector(self):
+        self._pos += 1
+        tokens = [self._time_selector()]
+        if self._keyword('over'):
+            tokens.append('over')
+            tokens.append(self._time_selector())
+        self._expect_char(']')
+        return RangeSelector(tokens)
+
+    def _offset_selector(self):
+        match = self._match(_TIME_SELECTOR)
+        if match is not None:
+            return OffsetSelector(['offset', match.group(1) + match.group(2)])
+        timestamp = self._expect(_ISO_TIMESTAMP, 'time selector or ISO timestamp')
+        return OffsetSelector(['offset', validate_iso_timestamp(timestamp)])
+
+
+def parse(expr):
+    return PrattParser(expr).parse()
@@ -0,0 +1,183 @@
+import operator
+
+import influx_repo
+from data_types import VectorRange, BooleanVectorRange
+from query_structures import (EvaluationContext,
+                              realign,
+                              MetricSelector,
+                              FuncStmt,
+                              Expression,
+                              BooleanExpression,
+                              LogicalExpression)
+import utils
+
+# A parsed tree flattened into a list of steps, so evaluating it again only
+# runs the steps instead of walking the tree and dispatching on node and
+# operator types at every node.
+
+_ARITHMETIC_OPERATORS = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.div}
+_RELATIONAL_OPERATORS = {'>=': operator.ge, '>': operator.gt, '<=': operator.le, '<': operator.lt}
+_LOGICAL_OPERATORS = {'and': operator.and_, 'or': operator.or_}
+
+
+def _fetch_step(selector, function):
+    key = (selector.canonical_key, selector.fetch_function(function))
+
+    def step(context):
+        if key in context.errors:
+            raise context.errors[key]
+        result = context.results.get(key)
+        if result is None:
+            result = context.results[key] = selector.fetch(function, context)
+        return result
+    return step
+
+
+def _function_step(function):
+    def step(context, value):
+        if isinstance(value, (VectorRange, BooleanVectorRange)):
+            return value.apply_function(function, None)
+        elif isinstance(value, (int, float)):
+            return utils.apply_function_to_scalar(value, function, None)
+        else:
+            raise Exception('Unexpected input type {} for functions'.format(type(value)))
+    return step
+
+
+def _binary_step(node, apply_operator, exception, align):
+    def step(context, left, right):
+        if align:
+            right = realign(node, right, context)
+        if left is None:
+            raise exception('Failed to evaluate ' + str(node))
+        elif right is None:
+            return left
+        return apply_operator(left, right)
+    return step
+
+
+def _has_selector(node):
+    if isinstance(node, MetricSelector):
+        return True
+    if isinstance(node, FuncStmt):
+        return _has_selector(node.operand)
+    if isinstance(node, (Expression, BooleanExpression, LogicalExpression)):
+        return _has_selector(node.left_operand) or _has_selector(node.right_operand)
+    return False
+
+
+class Program(object):
+    """A tree compiled into steps, evaluated without walking the tree.
+
+    Every step computes one slot from the slots before it, constants sit
+    in their slots from the start and parts of the tree with the same
+    canonical key share a slot, so each is computed once as with
+    EvaluationContext.subtrees. Operators are bound to their functions and
+    operations on constants are done while compiling. Selectors read
+    context.results and fetch what is missing, as MetricSelector.evaluate.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.steps = []
+        self.initial_slots = []
+        self._constants = {}
+        self._slots = {}
+        self.result_slot = self._compile(tree)
+
+    def _slot(self, value=None):
+        self.initial_slots.append(value)
+        return len(self.initial_slots) - 1
+
+    def _constant(self, value):
+        slot = self._slot(value)
+        self._constants[slot] = value
+        return slot
+
+    def _emit(self, step, sources, name):
+        slot = self._slot()
+        self.steps.append((slot, step, sources, name))
+        return slot
+
+    def _compile(self, node):
+        if not hasattr(node, 'evaluate'):
+            return self._constant(node)
+        key = node.canonical_key
+        if key not in self._slots:
+            if isinstance(node, MetricSelector):
+                self._slots[key] = self._emit(_fetch_step(node, None), (), 'fetch {}'.format(node.name))
+            elif isinstance(node, FuncStmt):
+                self._slots[key] = self._compile_function(node)
+            elif isinstance(node, Expression):
+                self._slots[key] = self._compile_binary(node, _ARITHMETIC_OPERATORS, node.operator, Exception)
+            elif isinstance(node, BooleanExpression):
+                self._slots[key] = self._compile_binary(node, _RELATIONAL_OPERATORS, node.normalized_operator,
+                                                        utils.EvalException)
+            elif isinstance(node, LogicalExpression):
+                self._slots[key] = self._compile_binary(node, _LOGICAL_OPERATORS, node.normalized_operator,
+                                                        utils.EvalException)
+            else:
+                raise Exception('Cannot compile {}'.format(type(node)))
+        return self._slots[key]
+
+    def _compile_function(self, node):
+        # a function the database computes is part of the fetch
+        if isinstance(node.operand, MetricSelector):
+            repo_function = influx_repo.get_function(node.function)
+            if repo_function is not None:
+                return self._emit(_fetch_step(node.operand, repo_function), (),
+                                  'fetch {} {}'.format(repo_function, node.operand.name))
+
+        operand = self._compile(node.operand)
+        value = self._constants.get(operand)
+        if isinstance(value, (int, float)):
+            return self._constant(utils.apply_function_to_scalar(value, node.function, None))
+        return self._emit(_function_step(node.function), (operand,), node.function)
+
+    def _compile_binary(self, node, operators, op, exception):
+        left = self._compile(node.left_operand)
+        if node.operator is None:
+            return left
+        if op not in operators:
+            raise utils.EvalException('Unknown operator \'{}\''.format(node.operator))
+        apply_operator = operators[op]
+        right = self._compile(node.right_operand)
+
+        if left in self._constants and right in self._constants:
+            try:
+                return self._constant(apply_operator(self._constants[left], self._constants[right]))
+            except Exception:
+                # fails when evaluated, as the tree would
+                pass
+        align = _has_selector(node.left_operand) and _has_selector(node.right_operand)
+        return self._emit(_binary_step(node, apply_operator, exception, align), (left, right), op)
+
+    def evaluate(self, context=None):
+        if context is None:
+            context = EvaluationContext()
+        slots = list(self.initial_slots)
+        for slot, step, sources, name in self.steps:
+            slots[slot] = step(context, *[slots[source] for source in sources])
+        return slots[self.result_slot]
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __str__(self):
+        lines = []
+        for slot, value in sorted(self._constants.items()):
+            lines.append('{} = {}'.format(slot, value))
+        for slot, step, sources, name in self.steps:
+            lines.append('{} = {} {}'.format(slot, name, ' '.join(str(source) for source in sources)).rstrip())
+        lines.append('return {}'.format(self.result_slot))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return "Program(steps={},tree={})".format(len(self.steps), self.tree)
+
+
+def compile_tree(tree):
+    """The Program evaluating tree, a number is returned as it is."""
+    if not hasattr(tree, 'evaluate'):
+        return tree
+    return Program(tree)
@@ -1,14 +1,326 @@
+import collections
+import copy
 import datetime
+import re
+import threading
+from multiprocessing import pool
+
 import numpy
 
 import influx_repo
+import sliding_window
 from data_types import (VectorRange,
                         BinnedRange,
                         Range,
-                        BooleanVectorRange)
+                        BooleanVectorRange,
+                        make_vector_range,
+                        shift_time)
 import utils
 
 
+class EvaluationContext(object):
+    """State shared by every node while evaluating a single query.
+
+    `now` is the naive UTC instant relative offsets and default windows are
+    measured from, it defaults to the time the context is created.
+
+    Fetched selectors are kept in `results` by (selector, function) and
+    evaluated subtrees in `subtrees`, both by canonical key, so identical
+    parts of a query are fetched and computed once. Fetches that failed
+    while prefetching keep their exception in `errors`, by the same keys
+    as `results`, and raise it for the selectors using them. `fetches` counts the
+    trips to the database, `fetches_saved` the selectors served by an
+    identical one.
+
+    `windows`, when given, holds the SlidingWindow of every fetch and is
+    kept by the caller from one evaluation to the next.
+
+    `align` snaps the time windows of selectors, see MetricSelector.window.
+    `push_down_rate` has InfluxDB average rates per bucket, instead of
+    sending every point's rate to be binned and averaged here, for windows
+    starting on a bucket boundary.
+
+    `stream_chunk_size`, when given, has aggregates and bucketed rates
+    computed here from raw points read in chunks of that many points, see
+    InfluxRepository.query, so memory stays bounded on long ranges.
+    """
+
+    def __init__(self, now=None, windows=None, window_lag_sec=60, align=None, push_down_rate=True,
+                 stream_chunk_size=None):
+        if now is None:
+            now = datetime.datetime.utcnow()
+        self.now = now
+        self.align = align
+        self.push_down_rate = push_down_rate
+        self.stream_chunk_size = stream_chunk_size
+        self.windows = windows
+        self.window_lag_sec = window_lag_sec
+        self.results = {}
+        self.errors = {}
+        self.subtrees = {}
+        self.fetches = 0
+        self.fetches_saved = 0
+        self._lock = threading.Lock()
+
+    def count_fetch(self):
+        with self._lock:
+            self.fetches += 1
+
+    def window(self, key):
+        with self._lock:
+            if key not in self.windows:
+                self.windows[key] = sliding_window.SlidingWindow(self.window_lag_sec)
+            return self.windows[key]
+
+
+def _canonical_key(operand):
+    if hasattr(operand, 'canonical_key'):
+        return operand.canonical_key
+    return operand
+
+
+def _fetches(operand):
+    if hasattr(operand, 'fetches'):
+        return operand.fetches()
+    return []
+
+
+def _time_anchor(operand, context):
+    if hasattr(operand, 'time_anchor'):
+        return operand.time_anchor(context)
+    return None
+
+
+def realign(node, right, context):
+    """The result of node's right operand moved onto the left one's time line.
+
+    Operands whose windows end at different times, as with an offset, are
+    compared like with like: x [1h] - x [1h] offset 1w pairs each point
+    with the one a week before it.
+    """
+    left_anchor = _time_anchor(node.left_operand, context)
+    right_anchor = _time_anchor(node.right_operand, context)
+    if left_anchor is None or right_anchor is None or left_anchor == right_anchor:
+        return right
+    return shift_time(right, int((left_anchor - right_anchor).total_seconds() * 1000))
+
+
+def _evaluate_once(node, context):
+    key = node.canonical_key
+    if key not in context.subtrees:
+        context.subtrees[key] = node._evaluate(context)
+    return context.subtrees[key]
+
+
+def plan(tree):
+    """Group the fetches of a tree, or a list of trees, into as few statements as possible.
+
+    Returns (selector, functions) pairs and the number of fetches saved:
+    repeats of a selector and function are dropped, and aggregates of one
+    selector over its range share a single statement.
+    """
+    if isinstance(tree, list):
+        fetches = [fetch for subtree in tree for fetch in _fetches(subtree)]
+    else:
+        fetches = _fetches(tree)
+    statements = collections.OrderedDict()
+    for selector, function in fetches:
+        if function in influx_repo.aggregate_functions and selector.range_selector is not None:
+            key = (selector.canonical_key, 'aggregates')
+        else:
+            key = (selector.canonical_key, function)
+        functions = statements.setdefault(key, (selector, []))[1]
+        if function not in functions:
+            functions.append(function)
+    return statements.values(), len(fetches) - len(statements)
+
+
+def _union_key(selector):
+    # selectors that only differ in their window
+    key = selector.canonical_key
+    return key[:3] + key[5:]
+
+
+def _union_statements(statements, context):
+    """Merge raw fetches of one selector whose windows overlap or touch.
+
+    Returns the statements with each merged group replaced by a single
+    (selectors, [None]) statement fetching the union of their windows.
+    """
+    windows = collections.OrderedDict()
+    for selector, functions in statements:
+        if functions == [None] and selector.range_selector is not None:
+            windows.setdefault(_union_key(selector), []).append((selector.window(context), selector))
+
+    merged = {}
+    for group in windows.values():
+        group.sort(key=lambda window: window[0])
+        union = []
+        for (start_time, end_time), selector in group:
+            if union and start_time <= union[-1][1]:
+                union[-1][1] = max(union[-1][1], end_time)
+                union[-1][2].append(selector)
+            else:
+                union.append([start_time, end_time, [selector]])
+        for start_time, end_time, selectors in union:
+            if len(selectors) > 1:
+                for selector in selectors:
+                    merged[id(selector)] = selectors
+
+    result = []
+    for selector, functions in statements:
+        selectors = merged.get(id(selector))
+        if selectors is None:
+            result.append((selector, functions))
+        elif selectors[0] is selector:
+            result.append((selectors, functions))
+    return result
+
+
+def fetch_union(selectors, context):
+    """Fetch the raw points of selectors differing only in their window at once.
+
+    The union of the windows is fetched and sliced per selector, returns
+    {selector key: result} as MetricSelector.fetch would give each.
+    """
+    context.count_fetch()
+    windows = [selector.window(context) for selector in selectors]
+    start_time = min(window[0] for window in windows)
+    end_time = max(window[1] for window in windows)
+    key = ('union', tuple(selector.canonical_key for selector in selectors))
+    influx_result = selectors[0]._query(None, start_time, end_time, None, context, key)
+
+    results = {}
+    for selector, (start_time, end_time) in zip(selectors, windows):
+        # cut where the database would have for a fetch of the window alone
+        fetched_start, fetched_end = influx_repo.align_window(start_time, end_time)
+        start_ms = utils.to_epoch_ms(fetched_start)
+        end_ms = utils.to_epoch_ms(fetched_end)
+        sliced = []
+        for definition, data in influx_result:
+            data = data[(data.timestamps >= start_ms) & (data.timestamps < end_ms)]
+            # as with a fetch of its own, a series without points in the window is left out
+            if len(data):
+                sliced.append((definition, data))
+        results[selector.canonical_key] = selector.make_result(sliced, start_time, end_time,
+                                                               selector.range_selector.bucket_sec)
+    return results
+
+
+def _shared_key(selector, functions):
+    # selectors that only differ in the values of their dimensions
+    if selector.name is None or not selector.dimensions or any(dim.operator != '=' for dim in selector.dimensions):
+        return None
+    keys = tuple(sorted(dim.key for dim in selector.dimensions))
+    if len(set(keys)) != len(keys):
+        return None
+    canonical_key = selector.canonical_key
+    return (selector.name, keys) + canonical_key[3:] + (tuple(functions),)
+
+
+# characters to escape in a regex literal, '/' ends it
+_REGEX_SPECIAL = re.compile(r'([\\.+*?()|\[\]{}^$/])')
+
+
+def _value_pattern(values):
+    # an InfluxQL regex matching exactly one of values
+    return '/^(' + '|'.join(_REGEX_SPECIAL.sub(r'\\\1', value) for value in sorted(values)) + ')$/'
+
+
+def _shared_statements(statements):
+    """Merge fetches of selectors that only differ in their dimension values.
+
+    Each group fetches once with a regex of the values wanted for every
+    dimension, see SharedSelector, so statements on one metric for many
+    hosts become a single one.
+    """
+    groups = collections.OrderedDict()
+    for selector, functions in statements:
+        key = None if isinstance(selector, list) else _shared_key(selector, functions)
+        groups.setdefault(key if key is not None else id(selector), []).append((selector, functions))
+
+    result = []
+    for group in groups.values():
+        if len(group) == 1:
+            result.append(group[0])
+        else:
+            result.append((SharedSelector([selector for selector, functions in group]), group[0][1]))
+    return result
+
+
+def _run_statement(statement, context):
+    selector, functions = statement
+    if isinstance(selector, list):
+        results = fetch_union(selector, context)
+        return dict((key, {None: result}) for key, result in results.items())
+    if isinstance(selector, SharedSelector):
+        return selector.fetch(functions, context)
+    if len(functions) > 1:
+        results = selector.fetch_aggregates(functions, context)
+    else:
+        results = {functions[0]: selector.fetch(functions[0], context)}
+    return {selector.canonical_key: results}
+
+
+def _try_statement(statement, context):
+    # a failed statement fails the selectors it was fetching, not every statement
+    try:
+        return _run_statement(statement, context), {}
+    except Exception as ex:
+        selector, functions = statement
+        if isinstance(selector, SharedSelector):
+            selectors = selector.selectors
+        elif isinstance(selector, list):
+            selectors = selector
+        else:
+            selectors = [selector]
+        return {}, dict((selector.canonical_key, dict((function, ex) for function in functions))
+                        for selector in selectors)
+
+
+# thread pools by size, shared by every evaluation so recurring queries do
+# not start threads each time
+_worker_pools = {}
+_worker_pools_lock = threading.Lock()
+
+
+def _worker_pool(size):
+    with _worker_pools_lock:
+        if size not in _worker_pools:
+            _worker_pools[size] = pool.ThreadPool(size)
+        return _worker_pools[size]
+
+
+def prefetch(tree, context, max_workers):
+    """Fetch every selector of the tree up front, on up to max_workers threads.
+
+    Results land in context.results, where MetricSelector.evaluate picks
+    them up, so the tree is then reduced without waiting on the database.
+    A statement that fails leaves its exception in context.errors instead,
+    raised by the selectors it was fetching when they are evaluated. Raw fetches of a selector over overlapping or adjacent windows are
+    made once, see fetch_union, and selectors differing only in their
+    dimension values share a statement, see SharedSelector.
+    """
+    statements, saved = plan(tree)
+    context.fetches_saved += saved
+    statements = [(selector, functions) for selector, functions in statements
+                  if any((selector.canonical_key, function) not in context.results for function in functions)]
+    statements = _shared_statements(_union_statements(statements, context))
+    context.fetches_saved += sum(len(selector) - 1 for selector, functions in statements
+                                 if isinstance(selector, (list, SharedSelector)))
+    if len(statements) > 1 and max_workers > 1:
+        results = _worker_pool(max_workers).map(lambda statement: _try_statement(statement, context), statements)
+    else:
+        results = [_try_statement(statement, context) for statement in statements]
+    for result, errors in results:
+        for key, function_results in result.items():
+            for function, function_result in function_results.items():
+                context.results[(key, function)] = function_result
+        for key, function_errors in errors.items():
+            for function, error in function_errors.items():
+                context.errors[(key, function)] = error
+
+
 class Dimension(object):
     def __init__(self, tokens):
         self.args = tokens
@@ -52,6 +364,10 @@ class RangeSelector(object):
     def bucket_sec(self):
         return _convert_to_seconds(self.bucket_value, self.bucket_unit)
 
+    @property
+    def canonical_key(self):
+        return self.range_sec, self.bucket_sec
+
     def __repr__(self):
         _range = str(self.range_value) + self.range_unit
         _bucket = 'None'
@@ -67,12 +383,26 @@ class OffsetSelector(object):
     def __init__(self, tokens):
         self.args = tokens
         self.offset = tokens[1]
-        if isinstance(self.offset, datetime.datetime):
-            self.normalized_offset = self.offset
-        else:
-            time_diff_sec = _convert_to_seconds(int(self.offset[:-1]), self.offset[-1])
-            self.normalized_offset = datetime.datetime.utcnow() - datetime.timedelta(
-                seconds=time_diff_sec)
+        self.offset_sec = None
+        if not isinstance(self.offset, datetime.datetime):
+            self.offset_sec = _convert_to_seconds(int(self.offset[:-1]), self.offset[-1])
+
+    def resolve(self, now):
+        # relative offsets are resolved against the evaluation time, so a parsed
+        # (or cached) tree does not stay pinned to the instant it was parsed at
+        if self.offset_sec is None:
+            return self.offset
+        return now - datetime.timedelta(seconds=self.offset_sec)
+
+    @property
+    def normalized_offset(self):
+        return self.resolve(datetime.datetime.utcnow())
+
+    @property
+    def canonical_key(self):
+        if self.offset_sec is None:
+            return self.offset
+        return self.offset_sec
 
     def __repr__(self):
         return "Offset({})".format(self.offset)
@@ -87,20 +417,21 @@ class MetricSelector(object):
         self.name = None
         self.dimensions = []
         self.range_selector = None
-        self.offset = None
+        self.offset_selector = None
+        # scalar steps InfluxDB applies to the fetched values, see push_down
+        self.arithmetic = ()
+        self._canonical_key = None
         _dimensions = []
         for token in tokens:
             if isinstance(token, basestring):
                 self.name = token
-            elif isinstance(token, list):
-                _dimensions = token
             elif isinstance(token, RangeSelector):
                 self.range_selector = token
             elif isinstance(token, OffsetSelector):
-                self.offset = token.normalized_offset
-        # if there is no offset, default to now
-        if self.offset is None:
-            self.offset = datetime.datetime.utcnow()
+                self.offset_selector = token
+            else:
+                # dimension group, a ParseResults or a plain list
+                _dimensions = token
         # remove __name__ from dimension, apply to self.name if not supplied
         for dim in _dimensions:
             if dim.key == '__name__':
@@ -109,70 +440,220 @@ class MetricSelector(object):
             else:
                 self.dimensions.append(dim)
 
-    def evaluate(self, function=None):
-        end_time = self.offset
+    def resolve_offset(self, now):
+        # if there is no offset, default to now
+        if self.offset_selector is None:
+            return now
+        return self.offset_selector.resolve(now)
 
+    @property
+    def offset(self):
+        return self.resolve_offset(datetime.datetime.utcnow())
+
+    @property
+    def canonical_key(self):
+        # selectors fetching the same data compare equal, whatever their spelling;
+        # kept once built, nodes are not changed after parsing, see with_arithmetic
+        if self._canonical_key is None:
+            dimensions = tuple(sorted((dim.key, dim.operator, dim.value) for dim in self.dimensions))
+            self._canonical_key = ('selector', self.name, dimensions, _canonical_key(self.range_selector),
+                                   _canonical_key(self.offset_selector), self.arithmetic)
+        return self._canonical_key
+
+    def with_arithmetic(self, operator, number, number_first=False):
+        """A copy of the selector that has InfluxDB apply one more scalar step."""
+        selector = copy.copy(self)
+        selector.arithmetic = self.arithmetic + ((operator, number, number_first),)
+        selector._canonical_key = None
+        return selector
+
+    def fetch_function(self, function):
+        """The function fetch asks InfluxDB for, any of them reads the last point without a range."""
+        if self.range_selector is None:
+            return 'last_force'
+        return function
+
+    def fetches(self):
+        return [(self, self.fetch_function(None))]
+
+    def evaluate(self, function=None, context=None):
+        if context is None:
+            context = EvaluationContext()
+        key = (self.canonical_key, self.fetch_function(function))
+        if key in context.errors:
+            raise context.errors[key]
+        if key not in context.results:
+            context.results[key] = self.fetch(function, context)
+        return context.results[key]
+
+    def _query(self, function, start_time, end_time, bucket_size_sec, context, key=None):
+        def query(start_time, end_time):
+            return influx_repo.query(self.name, self.dimensions,
+                                     function=function,
+                                     start_time=start_time,
+                                     end_time=end_time,
+                                     bucket_size=bucket_size_sec,
+                                     group_by=['*'],
+                                     arithmetic=self.arithmetic,
+                                     chunk_size=context.stream_chunk_size)
+
+        # raw points and per bucket aggregates carry over between runs,
+        # whole window aggregates and derivatives do not
+        if (context.windows is None or function == 'derivative' or
+                not (function is None or bucket_size_sec is not None)):
+            return query(start_time, end_time)
+        if key is None:
+            key = (self.canonical_key, tuple(function) if isinstance(function, list) else function)
+        return context.window(key).fetch(query, start_time, end_time,
+                                         bucket_size_sec if function is not None else None)
+
+    def window(self, context):
+        """Start and end time of the data to fetch.
+
+        With context.align set to 'bucket' both are rounded down to the bucket
+        size, so bins match InfluxDB's group by time() and statements repeat
+        until the next bucket starts. A number of seconds rounds to that step.
+        """
+        end_time = self.resolve_offset(context.now)
+        if self.range_selector is not None:
+            range_sec = self.range_selector.range_sec
+        else:
+            # without a range the last value of the past 5 minutes is used
+            range_sec = 5 * 60
+
+        step_sec = context.align
+        if step_sec == 'bucket':
+            step_sec = self.range_selector.bucket_sec if self.range_selector is not None else None
+        if step_sec is not None:
+            end_time = influx_repo.align_time(end_time, step_sec)
+        start_time = end_time - datetime.timedelta(seconds=range_sec)
+        if step_sec is not None:
+            start_time = influx_repo.align_time(start_time, step_sec)
+        return start_time, end_time
+
+    def fetch_aggregates(self, functions, context):
+        """Fetch several aggregates over the range in one statement, as {function: result}."""
+        context.count_fetch()
+        start_time, end_time = self.window(context)
+        influx_results = self._query(list(functions), start_time, end_time,
+                                     self.range_selector.bucket_sec, context)
+        results = {}
+        for function in functions:
+            results[function] = make_vector_range([Range(serie_tuple[0], serie_tuple[1])
+                                                   for serie_tuple in influx_results[function]])
+        return results
+
+    def fetch(self, function, context):
+        context.count_fetch()
+        start_time, end_time = self.window(context)
+
+        average_bins = False
         if self.range_selector is not None:
-            start_time = end_time - datetime.timedelta(seconds=self.range_selector.range_sec)
             bucket_size_sec = self.range_selector.bucket_sec
 
-            # cannot group in influx with derivative
+            # influx cannot group a derivative by time, the per point rates are
+            # averaged per bucket around a subquery, while streaming or binned here.
+            # Only the bins here start at the window, a window off the buckets
+            # of group by time() is always binned here so its rates do not move
             if function == 'derivative' and bucket_size_sec is not None:
-                bucket_size_sec = None
+                aligned = start_time == influx_repo.align_time(start_time, bucket_size_sec)
+                if not aligned or (not context.push_down_rate and context.stream_chunk_size is None):
+                    bucket_size_sec = None
+                    average_bins = True
         else:
             function = 'last_force'
-            start_time = end_time - datetime.timedelta(minutes=5)
             bucket_size_sec = None
 
-        influx_result = influx_repo.query(self.name, self.dimensions,
-                                          function=function,
-                                          start_time=start_time,
-                                          end_time=end_time,
-                                          bucket_size=bucket_size_sec,
-                                          group_by=['*'])
+        influx_result = self._query(function, start_time, end_time, bucket_size_sec, context)
 
         # if we did a derivative, do binning here
-        if function == 'derivative':
-            function = None
-            bucket_size_sec = self.range_selector.bucket_sec
+        if average_bins:
+            return self.make_result(influx_result, start_time, end_time, self.range_selector.bucket_sec,
+                                    average_bins=True)
+        if function is not None:
+            bucket_size_sec = None
+        return self.make_result(influx_result, start_time, end_time, bucket_size_sec)
 
+    def make_result(self, influx_result, start_time, end_time, bucket_size_sec=None, average_bins=False):
+        """Wrap fetched series, binned here when bucket_size_sec is given."""
         result = []
         # Change into a binned series if necessary
-        if function is None and bucket_size_sec is not None:
-            unix_start = int((start_time - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
-            unix_end = int((end_time - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
-            bins = [i for i in range(unix_start, unix_end, bucket_size_sec * 1000)]
+        if bucket_size_sec is not None:
+            bins = numpy.arange(utils.to_epoch_ms(start_time), utils.to_epoch_ms(end_time), bucket_size_sec * 1000)
 
-            # do not include start time in bin edges
-            bins_inner_edges = bins[1:]
             for serie_tuple in influx_result:
-                final_bins = list(bins)
-                bin_data = [[] for _ in range(len(bins_inner_edges) + 1)]
-                final_data = []
-                bin_indexes = numpy.digitize(serie_tuple[1].f0, bins_inner_edges)
-
-                for i in range(len(bin_indexes)):
-                    bin_data[bin_indexes[i]].append((serie_tuple[1][i].f0, serie_tuple[1][i].f1))
-                for i in range(len(bin_data)):
-                    if len(bin_data[i]) > 0:
-                        final_data.append(numpy.rec.array(bin_data[i]))
-                    else:
-                        del final_bins[i]
-                result.append(BinnedRange(serie_tuple[0], numpy.array(final_bins), final_data))
+                timestamps, values, offsets = utils.bin_series(serie_tuple[1], bins)
+                binned = BinnedRange(serie_tuple[0], bins, timestamps, values, offsets)
+                result.append(binned.apply_function('avg') if average_bins else binned)
         else:
             for serie_tuple in influx_result:
                 result.append(Range(serie_tuple[0], serie_tuple[1]))
 
-        return VectorRange(result)
+        return make_vector_range(result)
+
+    def time_anchor(self, context):
+        # the end of the window, what an offset moves
+        return self.window(context)[1]
 
     def __repr__(self):
-        return "MetricSelector(name={},dimensions={},range={},offset={})".format(
-            self.name, self.dimensions, self.range_selector, self.offset)
+        arithmetic = ''
+        if self.arithmetic:
+            arithmetic = ',arithmetic={}'.format(self.arithmetic)
+        return "MetricSelector(name={},dimensions={},range={},offset={}{})".format(
+            self.name, self.dimensions, self.range_selector, self.offset_selector, arithmetic)
 
     # def __str__(self):
     #     return ' '.join(str(arg) for arg in self.args)
 
 
+class SharedSelector(object):
+    """Selectors that only differ in the values of their dimensions, fetched together.
+
+    The statement asks for every value wanted of each dimension, and each
+    selector then takes the series whose dimensions it matches, as its own
+    statement would have returned them.
+    """
+
+    def __init__(self, selectors):
+        self.selectors = selectors
+        values = collections.OrderedDict()
+        for selector in selectors:
+            for dim in selector.dimensions:
+                values.setdefault(dim.key, set()).add(dim.value)
+        self.selector = copy.copy(selectors[0])
+        self.selector.dimensions = [Dimension([key, '=', list(key_values)[0]]) if len(key_values) == 1 else
+                                    Dimension([key, '=~', _value_pattern(key_values)])
+                                    for key, key_values in values.items()]
+        self.selector._canonical_key = None
+
+    def __len__(self):
+        return len(self.selectors)
+
+    def fetch(self, functions, context):
+        """{selector key: {function: result}} for every selector."""
+        if len(functions) > 1:
+            results = self.selector.fetch_aggregates(functions, context)
+        else:
+            results = {functions[0]: self.selector.fetch(functions[0], context)}
+
+        # series by the values of the selectors' dimensions, all share the same keys
+        keys = sorted(dim.key for dim in self.selectors[0].dimensions)
+        by_values = {}
+        for function, result in results.items():
+            for series in result.data:
+                tags = series.definition[1] or {}
+                by_values.setdefault((function, tuple(tags.get(key) for key in keys)), []).append(series)
+
+        shared = {}
+        for selector in self.selectors:
+            dimensions = dict((dim.key, dim.value) for dim in selector.dimensions)
+            values = tuple(dimensions[key] for key in keys)
+            shared[selector.canonical_key] = dict(
+                (function, make_vector_range(by_values.get((function, values), [])))
+                for function in results)
+        return shared
+
+
 class FuncStmt(object):
     functions_for_repo = {
         'avg': 'mean',
@@ -187,22 +668,44 @@ class FuncStmt(object):
         self.args = tokens
         self.function = tokens[0]
         self.operand = tokens[1]
+        self._canonical_key = None
         # TODO add ability to specify extra arguments
         # self.extra_args = tokens[2:]
 
-    def evaluate(self):
+    def fetches(self):
+        if isinstance(self.operand, MetricSelector):
+            repo_function = influx_repo.get_function(self.function)
+            if repo_function is not None:
+                return [(self.operand, self.operand.fetch_function(repo_function))]
+        return _fetches(self.operand)
+
+    @property
+    def canonical_key(self):
+        if self._canonical_key is None:
+            self._canonical_key = 'function', self.function, _canonical_key(self.operand)
+        return self._canonical_key
+
+    def time_anchor(self, context):
+        return _time_anchor(self.operand, context)
+
+    def evaluate(self, context=None):
+        if context is None:
+            context = EvaluationContext()
+        return _evaluate_once(self, context)
+
+    def _evaluate(self, context):
         if hasattr(self.operand, 'evaluate'):
 
             # if metric selector try to pass in function
             if isinstance(self.operand, MetricSelector):
                 repo_function = influx_repo.get_function(self.function)
                 if repo_function is not None:
-                    result = self.operand.evaluate(repo_function)
+                    result = self.operand.evaluate(repo_function, context=context)
                     # format data if necessary
                     # bail out here, since there is no more to do
                     return result
 
-            inner_result = self.operand.evaluate()
+            inner_result = self.operand.evaluate(context=context)
         else:
             inner_result = self.operand
 
@@ -224,7 +727,12 @@ class FuncStmt(object):
 class Expression(object):
     def __init__(self, tokens):
         self.args = tokens[0]
+        # a chain of same precedence operators arrives as one flat group,
+        # fold it so the tree is left associative and no operand is dropped
+        if len(self.args) > 3:
+            self.args = [Expression([self.args[:-2]])] + list(self.args[-2:])
         self.left_operand = self.args[0]
+        self._canonical_key = None
         self.operator = None
         self.right_operand = None
         if len(self.args) > 1:
@@ -244,16 +752,39 @@ class Expression(object):
         else:
             raise utils.EvalException('Unknown operator \'{}\''.format(self.operator))
 
-    def evaluate(self):
+    def fetches(self):
+        return _fetches(self.left_operand) + _fetches(self.right_operand)
+
+    @property
+    def canonical_key(self):
+        if self._canonical_key is None:
+            self._canonical_key = ('expression', _canonical_key(self.left_operand), self.operator,
+                                   _canonical_key(self.right_operand))
+        return self._canonical_key
+
+    def time_anchor(self, context):
+        # results are on the left operand's time line, see realign
+        anchor = _time_anchor(self.left_operand, context)
+        if anchor is None:
+            anchor = _time_anchor(self.right_operand, context)
+        return anchor
+
+    def evaluate(self, context=None):
+        if context is None:
+            context = EvaluationContext()
+        return _evaluate_once(self, context)
+
+    def _evaluate(self, context):
         if hasattr(self.left_operand, 'evaluate'):
-            left = self.left_operand.evaluate()
+            left = self.left_operand.evaluate(context=context)
         else:
             left = self.left_operand
 
         if hasattr(self.right_operand, 'evaluate'):
-            right = self.right_operand.evaluate()
+            right = self.right_operand.evaluate(context=context)
         else:
             right = self.right_operand
+        right = realign(self, right, context)
 
         if left is None:
             raise Exception('Failed to evaluate ' + str(self))
@@ -275,6 +806,7 @@ class BooleanExpression(object):
     def __init__(self, tokens):
         self.args = tokens
         self.left_operand = tokens[0]
+        self._canonical_key = None
         self.operator = None
         self.right_operand = None
         if len(tokens) > 1:
@@ -306,16 +838,39 @@ class BooleanExpression(object):
         else:
             return self.operator
 
-    def evaluate(self):
+    def fetches(self):
+        return _fetches(self.left_operand) + _fetches(self.right_operand)
+
+    @property
+    def canonical_key(self):
+        if self._canonical_key is None:
+            self._canonical_key = ('boolean expression', _canonical_key(self.left_operand), self.normalized_operator,
+                                   _canonical_key(self.right_operand))
+        return self._canonical_key
+
+    def time_anchor(self, context):
+        # results are on the left operand's time line, see realign
+        anchor = _time_anchor(self.left_operand, context)
+        if anchor is None:
+            anchor = _time_anchor(self.right_operand, context)
+        return anchor
+
+    def evaluate(self, context=None):
+        if context is None:
+            context = EvaluationContext()
+        return _evaluate_once(self, context)
+
+    def _evaluate(self, context):
         if hasattr(self.left_operand, 'evaluate'):
-            left = self.left_operand.evaluate()
+            left = self.left_operand.evaluate(context=context)
         else:
             left = self.left_operand
 
         if hasattr(self.right_operand, 'evaluate'):
-            right = self.right_operand.evaluate()
+            right = self.right_operand.evaluate(context=context)
         else:
             right = self.right_operand
+        right = realign(self, right, context)
 
         if left is None:
             raise utils.EvalException('Failed to evaluate ' + str(self))
@@ -335,8 +890,12 @@ class BooleanExpression(object):
 
 class LogicalExpression(object):
     def __init__(self, tokens):
+        # fold chains of the same operator, as in Expression
+        if len(tokens[0]) > 3:
+            tokens = [[LogicalExpression([tokens[0][:-2]])] + list(tokens[0][-2:])]
         self.args = tokens
         self.left_operand = tokens[0][0]
+        self._canonical_key = None
         self.operator = None
         self.right_operand = None
         if len(tokens[0]) > 1:
@@ -353,16 +912,39 @@ class LogicalExpression(object):
         else:
             raise utils.EvalException('Unknown operator')
 
-    def evaluate(self):
+    def fetches(self):
+        return _fetches(self.left_operand) + _fetches(self.right_operand)
+
+    @property
+    def canonical_key(self):
+        if self._canonical_key is None:
+            self._canonical_key = ('logical expression', _canonical_key(self.left_operand), self.normalized_operator,
+                                   _canonical_key(self.right_operand))
+        return self._canonical_key
+
+    def time_anchor(self, context):
+        # results are on the left operand's time line, see realign
+        anchor = _time_anchor(self.left_operand, context)
+        if anchor is None:
+            anchor = _time_anchor(self.right_operand, context)
+        return anchor
+
+    def evaluate(self, context=None):
+        if context is None:
+            context = EvaluationContext()
+        return _evaluate_once(self, context)
+
+    def _evaluate(self, context):
         if hasattr(self.left_operand, 'evaluate'):
-            left = self.left_operand.evaluate()
+            left = self.left_operand.evaluate(context=context)
         else:
             left = self.left_operand
 
         if hasattr(self.right_operand, 'evaluate'):
-            right = self.right_operand.evaluate()
+            right = self.right_operand.evaluate(context=context)
         else:
             right = self.right_operand
+        right = realign(self, right, context)
 
         if left is None:
             raise utils.EvalException('Failed to evaluate ' + str(self))
@@ -390,6 +972,94 @@ class LogicalExpression(object):
         return self.__repr__()
 
 
+# threshold predicates under any()/all() answered by one aggregate per series:
+# any(x > t) is max(x) > t, all(x > t) is min(x) > t, and so on
+_PREDICATE_AGGREGATES = {
+    ('any', '>'): 'max', ('any', '>='): 'max', ('any', '<'): 'min', ('any', '<='): 'min',
+    ('all', '>'): 'min', ('all', '>='): 'min', ('all', '<'): 'max', ('all', '<='): 'max',
+}
+
+_FLIPPED_OPERATORS = {'>': '<', '>=': '<=', '<': '>', '<=': '>='}
+
+
+def _is_number(operand):
+    return isinstance(operand, (int, float)) and not isinstance(operand, bool)
+
+
+def _push_down_arithmetic(left, operator, right):
+    """The selector (or pushed down function of one) with the arithmetic applied, or None."""
+    number_first = _is_number(left)
+    operand, number = (right, left) if number_first else (left, right)
+    if not _is_number(number) or operator not in ('+', '-', '*', '/'):
+        return None
+    if isinstance(operand, MetricSelector):
+        return operand.with_arithmetic(operator, number, number_first)
+    # on a pushed down function the step applies to the aggregated value
+    if (isinstance(operand, FuncStmt) and isinstance(operand.operand, MetricSelector) and
+            influx_repo.get_function(operand.function) is not None):
+        return FuncStmt([operand.function, operand.operand.with_arithmetic(operator, number, number_first)])
+    return None
+
+
+def _push_down_predicate(function, expression):
+    """any()/all() of a threshold on a whole range as a comparison of one aggregate, or None."""
+    if not isinstance(expression, BooleanExpression):
+        return None
+    operator = expression.normalized_operator
+    selector, number = expression.left_operand, expression.right_operand
+    if _is_number(selector):
+        selector, number = number, selector
+        operator = _FLIPPED_OPERATORS.get(operator)
+    if (not isinstance(selector, MetricSelector) or not _is_number(number) or
+            (function, operator) not in _PREDICATE_AGGREGATES or
+            selector.range_selector is None or selector.range_selector.bucket_sec is not None or
+            selector.arithmetic):
+        return None
+    aggregate = FuncStmt([_PREDICATE_AGGREGATES[(function, operator)], selector])
+    return FuncStmt([function, BooleanExpression([aggregate, operator, number])])
+
+
+def push_down(node):
+    """Rewrite a tree so InfluxDB does the work it can, returning a new tree.
+
+    Scalar arithmetic on a selector, or on a function pushed down with it,
+    moves into the select clause: avg(x [5m over 1h]) * 100 fetches
+    mean(value) * 100, while avg(x [5m over 1h] * 100) fetches value * 100
+    and averages it here. A threshold on a whole range under any() or all()
+    becomes a threshold on its max or min, one row per series instead of
+    every point. A where clause would drop the series without a match,
+    which have to be reported false.
+    """
+    if isinstance(node, Expression):
+        left = push_down(node.left_operand)
+        right = push_down(node.right_operand)
+        if node.operator is not None and right is not None:
+            pushed = _push_down_arithmetic(left, node.operator, right)
+            if pushed is not None:
+                return pushed
+            return Expression([[left, node.operator, right]])
+        return Expression([[left]])
+    elif isinstance(node, BooleanExpression):
+        if node.operator is None:
+            return BooleanExpression([push_down(node.left_operand)])
+        return BooleanExpression([push_down(node.left_operand), node.operator, push_down(node.right_operand)])
+    elif isinstance(node, LogicalExpression):
+        if node.operator is None:
+            return LogicalExpression([[push_down(node.left_operand)]])
+        return LogicalExpression([[push_down(node.left_operand), node.operator, push_down(node.right_operand)]])
+    elif isinstance(node, FuncStmt):
+        pushed = _push_down_predicate(node.function, node.operand)
+        if pushed is not None:
+            return pushed
+        operand = push_down(node.operand)
+        if isinstance(operand, MetricSelector) and not isinstance(node.operand, MetricSelector):
+            # arithmetic inside the function applies to every point, while
+            # InfluxDB would apply it to the aggregate: keep the fetch raw
+            operand = Expression([[operand]])
+        return FuncStmt([node.function, operand])
+    return node
+
+
 def _convert_to_seconds(value, unit):
     if value is None or unit is None:
         return None
@@ -0,0 +1,104 @@
+import datetime
+import threading
+
+import influx_repo
+import timeseries
+import utils
+
+# State kept between evaluations of a recurring query, so each run only
+# fetches what changed since the previous one.
+
+
+def merge_results(previous, delta, start_ms, watermark_ms):
+    """Merge a delta fetch into the results of the previous run.
+
+    Points of the previous run before start_ms have left the window and are
+    dropped, those from watermark_ms on are replaced by the delta. Series
+    keep the order they first appeared in.
+    """
+    delta_series = {}
+    for definition, data in delta:
+        delta_series[utils.series_key(definition)] = data[data.timestamps >= watermark_ms]
+
+    merged = []
+    for definition, data in previous:
+        kept = data[(data.timestamps >= start_ms) & (data.timestamps < watermark_ms)]
+        new_data = delta_series.pop(utils.series_key(definition), None)
+        if new_data is not None:
+            kept = timeseries.concatenate((kept, new_data))
+        if len(kept):
+            merged.append((definition, kept))
+    for definition, data in delta:
+        new_data = delta_series.pop(utils.series_key(definition), None)
+        if new_data is not None and len(new_data):
+            merged.append((definition, new_data))
+    return merged
+
+
+class SlidingWindow(object):
+    """Results of one selector fetch, carried from one evaluation to the next.
+
+    The first run fetches the whole window. Later runs only fetch from the
+    watermark, lag_sec before the previous end, and drop what fell out of
+    the window. A run whose window does not overlap the watermark, or that
+    goes back in time, fetches the whole window.
+
+    With bucket_size_sec the results are aggregated per bucket by the
+    database: the watermark is rounded down to a bucket, as the last one
+    was still filling. When the window starts inside a bucket, the points
+    left of that bucket are fetched again in a second statement, so the
+    results match a full fetch.
+    """
+
+    def __init__(self, lag_sec=60):
+        self.lag_sec = lag_sec
+        self.results = None
+        self.end_time = None
+        self.watermark = None
+        self.full_fetches = 0
+        self.delta_fetches = 0
+        self._lock = threading.Lock()
+
+    def fetch(self, query, start_time, end_time, bucket_size_sec=None):
+        """Results of query(start_time, end_time), fetching only the delta when possible.
+
+        query returns results as influx_repo.query does, either a list of
+        (definition, data) or a dict of them per aggregate.
+        """
+        with self._lock:
+            if (self.results is None or self.watermark <= start_time or
+                    end_time < self.end_time):
+                results = query(start_time, end_time)
+                self.full_fetches += 1
+            else:
+                delta = query(self.watermark, end_time)
+                start_ms = utils.to_epoch_ms(start_time)
+                head = None
+                if bucket_size_sec is not None:
+                    bucket_start = influx_repo.align_time(start_time, bucket_size_sec)
+                    if bucket_start < start_time:
+                        # the bucket the window starts in lost its oldest
+                        # points, aggregate again what is left of it
+                        head_end = bucket_start + datetime.timedelta(seconds=bucket_size_sec)
+                        head = query(start_time, head_end)
+                        start_ms = utils.to_epoch_ms(head_end)
+                results = _merge(self.results, delta, start_ms, utils.to_epoch_ms(self.watermark))
+                if head is not None:
+                    results = _merge(head, results, utils.to_epoch_ms(bucket_start), start_ms)
+                self.delta_fetches += 1
+
+            watermark = end_time - datetime.timedelta(seconds=self.lag_sec)
+            if bucket_size_sec is not None:
+                watermark = influx_repo.align_time(watermark, bucket_size_sec)
+            self.results = results
+            self.end_time = end_time
+            self.watermark = max(watermark, start_time)
+            return results
+
+
+def _merge(previous, delta, start_ms, watermark_ms):
+    # merge_results for either form of results
+    if isinstance(delta, dict):
+        return dict((function, merge_results(previous[function], delta[function], start_ms, watermark_ms))
+                    for function in delta)
+    return merge_results(previous, delta, start_ms, watermark_ms)
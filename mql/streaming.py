@@ -0,0 +1,203 @@
+import collections
+
+import numpy
+
+import influx_repo
+import utils
+
+# Client side aggregation of raw points read from a chunked response, chunk
+# by chunk, so only one chunk of points is held in memory at a time.
+
+_OPERATORS = {'+': numpy.add, '-': numpy.subtract, '*': numpy.multiply, '/': numpy.divide}
+
+
+def can_stream(function, bucket_size=None):
+    """Whether the results of a statement for function can be aggregated here."""
+    if isinstance(function, (list, tuple)):
+        return all(name in influx_repo.aggregate_functions for name in function)
+    if function == 'derivative':
+        # per point rates are as large as the raw points, only stream their averages
+        return bucket_size is not None
+    return function in influx_repo.aggregate_functions
+
+
+def series_chunks(result_sets, column='value'):
+    """Decode each series of each chunk as it arrives, as (definition, data).
+
+    A series longer than a chunk comes in several parts with the same definition.
+    """
+    for result_set in result_sets:
+        for series in result_set.raw.get('series', []):
+            key = (series.get('name', 'results'), series.get('tags', None))
+            yield key, influx_repo.parse_series_columns(series, column)
+
+
+def apply_arithmetic(values, arithmetic):
+    # the same (operator, number, number_first) steps as influx_repo._apply_arithmetic
+    for operator, number, number_first in arithmetic or ():
+        if number_first:
+            values = _OPERATORS[operator](number, values)
+        else:
+            values = _OPERATORS[operator](values, number)
+    return values
+
+
+class _SeriesState(object):
+    def __init__(self, definition, bin_count):
+        self.definition = definition
+        self.count = numpy.zeros(bin_count, dtype=numpy.int64)
+        self.sum = numpy.zeros(bin_count)
+        self.min = numpy.full(bin_count, numpy.inf)
+        self.max = numpy.full(bin_count, -numpy.inf)
+        # times of the points picked by min and max, kept for the whole window only
+        self.min_time = numpy.zeros(bin_count, dtype=numpy.int64)
+        self.max_time = numpy.zeros(bin_count, dtype=numpy.int64)
+        self.rate_count = numpy.zeros(bin_count, dtype=numpy.int64)
+        self.rate_sum = numpy.zeros(bin_count)
+        # last point seen, the rate of the first point of the next chunk needs it
+        self.last_time = None
+        self.last_value = None
+
+
+class StreamAggregator(object):
+    """Running sum, count, min and max per series and bucket, and mean rates.
+
+    `bins` holds the start time in ms of every bucket, as in
+    utils.bin_series, or is None to aggregate the whole window into one
+    value stamped start_ms, or with the time of the point min or max picks
+    when asked for alone. State is kept per bucket, so memory depends on
+    the number of series and buckets, not on the number of points.
+    """
+
+    def __init__(self, start_ms, bins=None, rates=False):
+        self.start_ms = start_ms
+        self.bins = None if bins is None else numpy.asarray(bins, dtype=numpy.int64)
+        self.rates = rates
+        self.points = 0
+        self._series = collections.OrderedDict()
+
+    def _state(self, definition):
+        key = utils.series_key(definition)
+        state = self._series.get(key)
+        if state is None:
+            state = _SeriesState(definition, 1 if self.bins is None else len(self.bins))
+            self._series[key] = state
+        return state
+
+    def _bin_indexes(self, timestamps):
+        if self.bins is None:
+            return numpy.zeros(len(timestamps), dtype=numpy.intp)
+        return numpy.searchsorted(self.bins, timestamps, side='right') - 1
+
+    def add(self, definition, data):
+        if not len(data):
+            return
+        if numpy.any(data.timestamps[1:] < data.timestamps[:-1]):
+            data = data[numpy.argsort(data.timestamps, kind='mergesort')]
+        state = self._state(definition)
+        timestamps = data.timestamps.astype(numpy.int64)
+        values = data.values
+        indexes = self._bin_indexes(timestamps)
+        self.points += len(data)
+
+        bin_count = len(state.count)
+        inside = indexes >= 0
+        if not numpy.all(inside):
+            timestamps, values, indexes = timestamps[inside], values[inside], indexes[inside]
+        if len(indexes):
+            state.count += numpy.bincount(indexes, minlength=bin_count)
+            state.sum += numpy.bincount(indexes, weights=values, minlength=bin_count)
+            # points are time sorted, so each bucket is one run of indexes
+            starts = numpy.flatnonzero(numpy.concatenate(([True], indexes[1:] != indexes[:-1])))
+            touched = indexes[starts]
+            if self.bins is None:
+                # the first point with the lowest or highest value, over every chunk
+                low, high = numpy.argmin(values), numpy.argmax(values)
+                if values[low] < state.min[0]:
+                    state.min_time[0] = timestamps[low]
+                if values[high] > state.max[0]:
+                    state.max_time[0] = timestamps[high]
+            state.min[touched] = numpy.minimum(state.min[touched], numpy.minimum.reduceat(values, starts))
+            state.max[touched] = numpy.maximum(state.max[touched], numpy.maximum.reduceat(values, starts))
+
+        if self.rates and len(timestamps):
+            self._add_rates(state, timestamps, values, indexes, bin_count)
+
+    def _add_rates(self, state, timestamps, values, indexes, bin_count):
+        # derivative per second of every point from the one before it, as
+        # InfluxDB's derivative(value) stamps it with the later point
+        last_time, last_value = timestamps[-1], values[-1]
+        if state.last_time is not None:
+            previous_times = numpy.concatenate(([state.last_time], timestamps[:-1]))
+            previous_values = numpy.concatenate(([state.last_value], values[:-1]))
+        else:
+            previous_times, previous_values = timestamps[:-1], values[:-1]
+            timestamps, values, indexes = timestamps[1:], values[1:], indexes[1:]
+        state.last_time, state.last_value = last_time, last_value
+
+        elapsed = timestamps - previous_times
+        valid = elapsed > 0
+        rates = (values[valid] - previous_values[valid]) * 1000.0 / elapsed[valid]
+        state.rate_count += numpy.bincount(indexes[valid], minlength=bin_count)
+        state.rate_sum += numpy.bincount(indexes[valid], weights=rates, minlength=bin_count)
+
+    def _column(self, state, function):
+        if function == 'count':
+            return state.count > 0, state.count.astype(numpy.float64)
+        if function == 'sum':
+            return state.count > 0, state.sum
+        if function == 'mean':
+            return state.count > 0, state.sum / numpy.maximum(state.count, 1)
+        if function == 'min':
+            return state.count > 0, state.min
+        if function == 'max':
+            return state.count > 0, state.max
+        if function == 'derivative':
+            return state.rate_count > 0, state.rate_sum / numpy.maximum(state.rate_count, 1)
+        raise Exception('Cannot aggregate \'{}\' while streaming'.format(function))
+
+    def results(self, function, arithmetic=None, selector_time=False):
+        """Aggregated series as influx_repo.query returns them, empty buckets left out.
+
+        With selector_time, min and max over the whole window are stamped
+        with the point they picked, as InfluxDB does for a selector asked
+        for alone.
+        """
+        results = []
+        for state in self._series.values():
+            present, values = self._column(state, function)
+            if self.bins is None and selector_time and function == 'min':
+                timestamps = state.min_time
+            elif self.bins is None and selector_time and function == 'max':
+                timestamps = state.max_time
+            elif self.bins is None:
+                timestamps = numpy.array([self.start_ms], dtype=numpy.int64)
+            else:
+                timestamps = self.bins
+            results.append((state.definition,
+                            utils.get_result_array(timestamps[present],
+                                                   apply_arithmetic(values[present], arithmetic))))
+        return results
+
+
+def aggregate(result_sets, function, start_time, end_time, bucket_size=None, arithmetic=None):
+    """Aggregate the chunks of a raw fetch as InfluxDB would have for function.
+
+    Takes the ResultSets of a chunked response and returns the results as
+    influx_repo.query does. Only for functions can_stream accepts, buckets
+    start at multiples of bucket_size as with group by time().
+    """
+    if not can_stream(function, bucket_size):
+        raise Exception('Cannot stream \'{}\''.format(function))
+    bins = None
+    if bucket_size is not None:
+        bin_start = influx_repo.align_time(start_time, bucket_size)
+        bins = numpy.arange(utils.to_epoch_ms(bin_start), utils.to_epoch_ms(end_time), bucket_size * 1000)
+
+    aggregator = StreamAggregator(utils.to_epoch_ms(start_time), bins, rates=function == 'derivative')
+    for definition, data in series_chunks(result_sets):
+        aggregator.add(definition, data)
+
+    if isinstance(function, (list, tuple)):
+        return dict((name, aggregator.results(name, arithmetic)) for name in function)
+    return aggregator.results(function, arithmetic, selector_time=True)
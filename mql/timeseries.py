@@ -0,0 +1,110 @@
+import numpy
+
+# Storage for the points of one series. Timestamps and values are kept as
+# two contiguous arrays rather than interleaved records, so arithmetic on
+# the values reads consecutive memory and needs no field lookup.
+
+TIMESTAMP_DTYPE = numpy.uint64
+
+# the largest gap between two points a compact series can hold, in ms
+MAX_COMPACT_DELTA = numpy.iinfo(numpy.int32).max
+
+
+class Series(object):
+    """Timestamps in ms since the epoch and the values at them.
+
+    Indexing with a slice, a mask or an array of indexes selects points and
+    returns a Series.
+    """
+
+    __slots__ = ('timestamps', 'values')
+
+    def __init__(self, timestamps, values):
+        self.timestamps = timestamps
+        self.values = values
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, index):
+        return Series(self.timestamps[index], self.values[index])
+
+    @property
+    def nbytes(self):
+        return self.timestamps.nbytes + self.values.nbytes
+
+    def tolist(self):
+        return zip(self.timestamps.tolist(), self.values.tolist())
+
+    def __repr__(self):
+        return 'Series({})'.format(self.tolist())
+
+
+def _deltas(series):
+    timestamps = series.timestamps.astype(numpy.int64)
+    deltas = numpy.diff(timestamps, prepend=timestamps[:1])
+    if numpy.any(deltas < 0) or numpy.any(deltas > MAX_COMPACT_DELTA):
+        return None
+    return deltas
+
+
+class CompactSeries(object):
+    """A float Series in about half the memory, for results that are kept around.
+
+    Timestamps are stored as int32 differences from the previous point,
+    the first from `start`, and values as float32, so values keep about 7
+    significant digits. Points must be time sorted and less than ~24 days
+    apart, see can_compact. `expand` gives back a Series.
+    """
+
+    __slots__ = ('start', 'deltas', 'values')
+
+    def __init__(self, start, deltas, values):
+        self.start = start
+        self.deltas = deltas
+        self.values = values
+
+    @classmethod
+    def from_series(cls, series):
+        deltas = _deltas(series)
+        if deltas is None:
+            raise Exception('Cannot compact unsorted or sparse series')
+        start = int(series.timestamps[0]) if len(series) else 0
+        return cls(start, deltas.astype(numpy.int32), series.values.astype(numpy.float32))
+
+    def __len__(self):
+        return len(self.deltas)
+
+    @property
+    def nbytes(self):
+        return self.deltas.nbytes + self.values.nbytes
+
+    def expand(self):
+        timestamps = (self.start + numpy.cumsum(self.deltas, dtype=numpy.int64)).astype(TIMESTAMP_DTYPE)
+        return Series(timestamps, self.values.astype(numpy.float64))
+
+
+def empty(rows, dtype=numpy.float64):
+    return Series(numpy.empty(int(rows), dtype=TIMESTAMP_DTYPE), numpy.empty(int(rows), dtype=dtype))
+
+
+def concatenate(series_list):
+    return Series(numpy.concatenate([series.timestamps for series in series_list]),
+                  numpy.concatenate([series.values for series in series_list]))
+
+
+def can_compact(series):
+    return series.values.dtype.kind == 'f' and _deltas(series) is not None
+
+
+def compact(series):
+    """The CompactSeries of series, or series itself when it cannot be compacted."""
+    if can_compact(series):
+        return CompactSeries.from_series(series)
+    return series
+
+
+def expand(series):
+    if isinstance(series, CompactSeries):
+        return series.expand()
+    return series
@@ -1,20 +1,19 @@
-import numpy
-
+import datetime
 
-class EvalException(Exception):
-    pass
+import numpy
 
+import timeseries
 
-def create_rec_array(rows):
-    return numpy.recarray((int(rows)), dtype=[('f0', numpy.uint64), ('f1', numpy.float64)])
+_EPOCH = datetime.datetime(1970, 1, 1)
 
 
-def create_bool_rec_array(rows):
-    return numpy.recarray((int(rows)), dtype=[('f0', numpy.uint64), ('f1', numpy.bool_)])
+class EvalException(Exception):
+    pass
 
 
 def validate_timestamp_matching(left, right):
-    diff = left - right
+    # timestamps may be unsigned, subtract them signed so they cannot wrap
+    diff = left.astype(numpy.int64) - right.astype(numpy.int64)
     abs_diff = numpy.absolute(diff)
     bool_diff = abs_diff > 60000
     if numpy.any(bool_diff):
@@ -39,19 +38,156 @@ def reduce_definitions(left, right):
     return tuple((result_name, reduced_dimensions))
 
 
+def matching_key(definition, on=None, ignoring=None):
+    """Hashable key of the dimensions two series are matched on.
+
+    By default every dimension takes part, `on` restricts the key to the
+    given dimension names and `ignoring` leaves the given names out.
+    """
+    dimensions = definition[1] or {}
+    if on is not None:
+        return tuple((key, dimensions.get(key)) for key in on)
+    if ignoring is not None:
+        return frozenset(item for item in dimensions.items() if item[0] not in ignoring)
+    return frozenset(dimensions.items())
+
+
+def match_definitions(left, right, on=None, ignoring=None):
+    """Hash join two lists of series definitions on their dimensions.
+
+    Returns the indexes of the matching pairs, in the order of `left`.
+    Series without a partner are left out, a single series on each side is
+    always paired, and more than one series per key on a side is an error.
+    """
+    if len(left) == 1 and len(right) == 1:
+        return [0], [0]
+
+    right_index = {}
+    for i, definition in enumerate(right):
+        key = matching_key(definition, on, ignoring)
+        if key in right_index:
+            raise Exception('Multiple series match dimensions {}'.format(dict(key)))
+        right_index[key] = i
+
+    left_indexes = []
+    right_indexes = []
+    matched_keys = set()
+    for i, definition in enumerate(left):
+        key = matching_key(definition, on, ignoring)
+        j = right_index.get(key)
+        if j is None:
+            continue
+        if key in matched_keys:
+            raise Exception('Multiple series match dimensions {}'.format(dict(key)))
+        matched_keys.add(key)
+        left_indexes.append(i)
+        right_indexes.append(j)
+    return left_indexes, right_indexes
+
+
+def series_key(definition):
+    """Hashable key of a (name, tags) series definition."""
+    name, tags = definition
+    return name, frozenset((tags or {}).items())
+
+
+# how asof_indexes reads a series between its points
+INTERPOLATIONS = ('previous', 'nearest', 'linear')
+
+
+def asof_indexes(timestamps, series_timestamps, tolerance_ms, interpolation='nearest'):
+    """Where to read a time sorted series at each of `timestamps`, vectorized.
+
+    Returns (matched, lower, upper, weight), the value at timestamps[i] is
+    values[lower[i]] * (1 - weight[i]) + values[upper[i]] * weight[i] where
+    matched[i], see asof_values. 'previous' reads the last point at or
+    before the timestamp, 'nearest' the closest one, 'linear' interpolates
+    between the points around it. Only points within tolerance_ms are read,
+    'linear' reads the nearest point where one of the two is out of reach.
+    """
+    if interpolation not in INTERPOLATIONS:
+        raise Exception('Unknown interpolation \'{}\''.format(interpolation))
+    timestamps = numpy.asarray(timestamps).astype(numpy.int64)
+    series_timestamps = numpy.asarray(series_timestamps).astype(numpy.int64)
+    count = len(series_timestamps)
+    if count == 0:
+        nowhere = numpy.zeros(len(timestamps), dtype=numpy.intp)
+        return numpy.zeros(len(timestamps), dtype=numpy.bool_), nowhere, nowhere, numpy.zeros(len(timestamps))
+
+    after = numpy.searchsorted(series_timestamps, timestamps, side='right')
+    before = numpy.clip(after - 1, 0, count - 1)
+    # distance to the points around each timestamp, out of reach where there is none
+    out_of_reach = numpy.iinfo(numpy.int64).max
+    before_gap = numpy.where(after > 0, timestamps - series_timestamps[before], out_of_reach)
+    after = numpy.clip(after, 0, count - 1)
+    after_gap = numpy.where(series_timestamps[after] > timestamps, series_timestamps[after] - timestamps,
+                            out_of_reach)
+
+    if interpolation == 'previous':
+        return before_gap <= tolerance_ms, before, before, numpy.zeros(len(timestamps))
+
+    nearest = numpy.where(after_gap < before_gap, after, before)
+    matched = numpy.minimum(before_gap, after_gap) <= tolerance_ms
+    if interpolation == 'nearest':
+        return matched, nearest, nearest, numpy.zeros(len(timestamps))
+
+    between = (before_gap > 0) & (before_gap <= tolerance_ms) & (after_gap <= tolerance_ms)
+    span = numpy.where(between, series_timestamps[after] - series_timestamps[before], 1)
+    weight = numpy.where(between, before_gap, 0) / span.astype(numpy.float64)
+    return matched, numpy.where(between, before, nearest), numpy.where(between, after, nearest), weight
+
+
+def asof_values(values, lower, upper, weight):
+    """Values read at the positions asof_indexes gave, along the last axis."""
+    if not numpy.any(weight):
+        return numpy.take(values, lower, axis=-1)
+    return numpy.take(values, lower, axis=-1) * (1 - weight) + numpy.take(values, upper, axis=-1) * weight
+
+
+def to_epoch_ms(timestamp):
+    """Milliseconds since the epoch of a naive UTC datetime."""
+    return int((timestamp - _EPOCH).total_seconds() * 1000)
+
+
+def shift_timestamps(timestamps, shift_ms):
+    # through int64, so an unsigned array can be moved back as well
+    return (timestamps.astype(numpy.int64) + shift_ms).astype(timestamps.dtype)
+
+
 def get_result_array(timestamps, values):
-    result = create_rec_array(len(timestamps))
-    result.f0 = timestamps
-    result.f1 = values
+    result = timeseries.empty(len(timestamps))
+    result.timestamps[:] = timestamps
+    result.values[:] = values
     return result
 
 
 def get_boolean_result_array(timestamps, values):
-    result = create_bool_rec_array(len(timestamps))
-    result.f0 = timestamps
-    result.f1 = values
+    result = timeseries.empty(len(timestamps), numpy.bool_)
+    result.timestamps[:] = timestamps
+    result.values[:] = values
     return result
 
 
+def bin_series(data, bins):
+    """Assign the points of a series to time bins.
+
+    `bins` holds the start time of every bin, a point falls into the last bin
+    starting at or before it. Returns the time sorted timestamps and values
+    and the offset of the first point of each bin, empty bins included.
+    """
+    bins = numpy.asarray(bins)
+    if numpy.any(data.timestamps[1:] < data.timestamps[:-1]):
+        # stable, so points sharing a timestamp keep their order
+        data = data[numpy.argsort(data.timestamps, kind='mergesort')]
+    timestamps = numpy.ascontiguousarray(data.timestamps)
+    values = numpy.ascontiguousarray(data.values)
+    offsets = numpy.concatenate(([0], numpy.searchsorted(timestamps, bins[1:], side='left')))
+    return timestamps, values, offsets
+
+
+def bin_counts(offsets, total):
+    return numpy.diff(numpy.append(offsets, total))
+
+
 def apply_function_to_scalar(scalar, function, extra_args=None):
     return scalar
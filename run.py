@@ -1,12 +1,33 @@
 import sys
 
+from mql import benchmarks
+from mql import checks
 from mql import mql_parser
 
 if len(sys.argv) == 1 or sys.argv[1] == 'test':
-    sys.exit(mql_parser.main())
+    sys.exit(mql_parser.main() or checks.main())
 
-parsed_query = mql_parser.MQLParser(sys.argv[1]).parse()
+# bench [packrat] [pratt] [max mean parse latency in ms]
+# bench <name> for any of the other benchmarks
+if sys.argv[1] == 'bench':
+    args = sys.argv[2:]
+    if args and args[0] in benchmarks.benchmarks:
+        sys.exit(benchmarks.benchmarks[args[0]]())
+    packrat = 'packrat' in args
+    backend = 'pratt' if 'pratt' in args else 'pyparsing'
+    budget = [float(arg) for arg in args if arg not in ('packrat', 'pratt')]
+    sys.exit(mql_parser.benchmark_main(budget[0] if budget else None, packrat=packrat, backend=backend))
 
-results = parsed_query[0].evaluate()
+# check <query>, compare results with and without pushdown to the database
+if sys.argv[1] == 'check':
+    sys.exit(mql_parser.check_pushdown(sys.argv[2]))
+
+# batch <file>, evaluate the expressions of a file, one per line, together
+if sys.argv[1] == 'batch':
+    sys.exit(mql_parser.batch_main(sys.argv[2]))
+
+prepared_query = mql_parser.MQLParser(sys.argv[1]).prepare()
+
+results = prepared_query.evaluate()
 
 print(results)